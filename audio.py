@@ -0,0 +1,579 @@
+from collections import deque
+import os
+import threading
+import time
+from typing import Callable
+
+import discord
+from discord.oggparse import OggStream
+from discord.opus import Decoder as OpusDecoder, Encoder as OpusEncoder, OPUS_SILENCE
+import numpy as np
+
+
+# librespot's pipe backend writes 44.1 kHz signed 16 bit little endian stereo. Discord wants the
+# same at 48 kHz, in 20 ms frames. 20 ms is exactly 882 input samples and 960 output samples
+CHANNELS = 2
+SAMPLE_WIDTH = 2
+INPUT_RATE = 44100
+OUTPUT_RATE = 48000
+INPUT_FRAME_SAMPLES = INPUT_RATE // 50
+OUTPUT_FRAME_SAMPLES = OUTPUT_RATE // 50
+INPUT_FRAME_BYTES = INPUT_FRAME_SAMPLES * CHANNELS * SAMPLE_WIDTH
+OUTPUT_FRAME_BYTES = OUTPUT_FRAME_SAMPLES * CHANNELS * SAMPLE_WIDTH
+
+# Which `AudioSource` plays music. See `create_music_source`
+MUSIC_AUDIO_SOURCE = os.getenv("MUSIC_AUDIO_SOURCE", "python")
+
+# Opus bitrates, in kbps, that discord.py's encoder accepts. Voice channel bitrates are clamped to these
+MIN_OPUS_BITRATE = 16
+MAX_OPUS_BITRATE = 512
+
+# How many of the most recent frames `SendTimer` keeps timings for
+SEND_TIME_WINDOW = 500
+
+# How many encoded frames a broadcast subscriber can fall behind by before its oldest frames are dropped
+BROADCAST_QUEUE_FRAMES = 25
+
+# How long a broadcast subscriber waits for the next frame before sending silence instead
+BROADCAST_READ_TIMEOUT = OpusEncoder.FRAME_LENGTH / 1000
+
+# How loud music is while `Mixer` is playing clips over it. 1 leaves it as it is
+MIXER_DUCK_GAIN = float(os.getenv("MIXER_DUCK_GAIN", 1.0))
+
+# How many frames `Mixer` takes to duck the music, and to bring it back up after the last clip
+MIXER_DUCK_FRAMES = 5
+
+# The loudest a 16 bit sample can be
+MAX_SAMPLE = 32767
+MIN_SAMPLE = -32768
+
+
+class ResampledPCMAudio(discord.AudioSource):
+    """
+    Reads librespot's 44.1 kHz pipe and resamples it to 48 kHz in process with linear
+    interpolation, so no ffmpeg process is needed. Each frame is read into the same buffer and
+    resampled with the same precomputed indices
+
+    :param pipe: A file-like object with `readinto`, such as from `spotify_controller.get_librespot_audio`
+    """
+
+    def __init__(self, pipe) -> None:
+        self.pipe = pipe
+        self._input = bytearray(INPUT_FRAME_BYTES)
+        self._input_view = memoryview(self._input)
+        # One sample from the end of the previous frame is kept in front of each new frame, so
+        # output samples that fall between two frames can still be interpolated. Samples stay
+        # interleaved, so the indices below point at each channel of each sample
+        self._samples = np.zeros((INPUT_FRAME_SAMPLES + 1) * CHANNELS, dtype=np.float32)
+        self._below = np.empty(OUTPUT_FRAME_SAMPLES * CHANNELS, dtype=np.float32)
+        self._above = np.empty(OUTPUT_FRAME_SAMPLES * CHANNELS, dtype=np.float32)
+        self._output = np.empty(OUTPUT_FRAME_SAMPLES * CHANNELS, dtype="<i2")
+
+        positions = np.arange(OUTPUT_FRAME_SAMPLES, dtype=np.float64) * INPUT_RATE / OUTPUT_RATE
+        index = positions.astype(np.intp)
+        self._index_below = (index[:, np.newaxis] * CHANNELS + np.arange(CHANNELS)).ravel()
+        self._index_above = self._index_below + CHANNELS
+        self._fraction = np.repeat((positions - index).astype(np.float32), CHANNELS)
+
+    def read(self) -> bytes:
+        filled = 0
+        while filled < INPUT_FRAME_BYTES:
+            read = self.pipe.readinto(self._input_view[filled:])
+            if not read:
+                return b""
+            filled += read
+
+        self._samples[:CHANNELS] = self._samples[-CHANNELS:]
+        self._samples[CHANNELS:] = np.frombuffer(self._input, dtype="<i2")
+
+        np.take(self._samples, self._index_below, out=self._below)
+        np.take(self._samples, self._index_above, out=self._above)
+        np.subtract(self._above, self._below, out=self._above)
+        np.multiply(self._above, self._fraction, out=self._above)
+        np.add(self._below, self._above, out=self._above)
+        np.copyto(self._output, self._above, casting="unsafe")
+        return self._output.tobytes()
+
+    def is_opus(self) -> bool:
+        return False
+
+
+class OggOpusAudio(discord.AudioSource):
+    """
+    Plays the packets of an Ogg/Opus file as they are, with no ffmpeg process and no decoding. The 
+    file must be 48 kHz stereo Opus in 20 ms frames, like the soundboard's normalized renditions
+
+    :param path: The path of the Ogg/Opus file
+    """
+
+    def __init__(self, path: str) -> None:
+        self._file = open(path, "rb")
+        self._packets = OggStream(self._file).iter_packets()
+
+    def read(self) -> bytes:
+        for packet in self._packets:
+            # The stream starts with header packets, which are not audio
+            if not packet.startswith((b"OpusHead", b"OpusTags")):
+                return packet
+        return b""
+
+    def is_opus(self) -> bool:
+        return True
+
+    def cleanup(self):
+        self._file.close()
+
+
+class FramesAudio(discord.AudioSource):
+    """
+    Plays frames that are already in memory, such as a cached soundboard clip
+
+    :param frames: 20 ms frames, either Opus packets or 48 kHz stereo PCM
+    :param is_opus: Whether `frames` are Opus packets
+    """
+
+    def __init__(self, frames, is_opus: bool) -> None:
+        self._frames = iter(frames)
+        self._is_opus = is_opus
+
+    def read(self) -> bytes:
+        return next(self._frames, b"")
+
+    def is_opus(self) -> bool:
+        return self._is_opus
+
+
+class FirstFrameHook(discord.AudioSource):
+    """
+    Plays another source as it is, calling `on_start` from the voice thread just before its first 
+    frame is read. Used to time how long a sound takes to start playing
+
+    :param source: The source to play
+    :param on_start: Called once, with no arguments
+    """
+
+    def __init__(self, source: discord.AudioSource, on_start: Callable[[], None]) -> None:
+        self.source = source
+        self._on_start: Callable[[], None] | None = on_start
+
+    def read(self) -> bytes:
+        if self._on_start is not None:
+            on_start, self._on_start = self._on_start, None
+            on_start()
+        return self.source.read()
+
+    def is_opus(self) -> bool:
+        return self.source.is_opus()
+
+    def cleanup(self):
+        self.source.cleanup()
+
+
+def opus_bitrate(channel) -> int:
+    """
+    :param channel: A voice channel
+    :returns: The channel's bitrate in kbps, clamped to what the Opus encoder accepts
+    """
+    return min(max(channel.bitrate // 1000, MIN_OPUS_BITRATE), MAX_OPUS_BITRATE)
+
+
+def create_music_source(pipe, bitrate: int = 128) -> discord.AudioSource:
+    """
+    Builds the `AudioSource` that plays librespot's audio to a voice channel. Set the
+    `MUSIC_AUDIO_SOURCE` environment variable to choose which one
+
+    - `python` (default) - `ResampledPCMAudio`. Resamples in process. discord.py encodes Opus 
+      in the voice thread
+    - `ffmpeg` - `discord.FFmpegPCMAudio`. Resamples in an ffmpeg process. discord.py encodes 
+      Opus in the voice thread
+    - `opus` - `discord.FFmpegOpusAudio`. Resamples and encodes Opus in an ffmpeg process, so 
+      the voice thread only sends packets
+
+    :param pipe: librespot's audio, such as from `spotify_controller.get_librespot_audio`
+    :param bitrate: The Opus bitrate in kbps for the `opus` source. See `opus_bitrate`
+    """
+    if MUSIC_AUDIO_SOURCE == "ffmpeg":
+        return discord.FFmpegPCMAudio(
+            pipe=True,
+            source=pipe,
+            before_options="-f s16le -ar 44100 -ac 2",
+            options="-f s16le -ar 48000 -ac 2",
+        )
+    if MUSIC_AUDIO_SOURCE == "opus":
+        # `-re` reads the pipe in real time. The pipe never runs dry, so without it ffmpeg would 
+        # encode as fast as it can and seconds of audio would pile up waiting to be sent. Short 
+        # Ogg pages hand each packet over as soon as it is encoded rather than a second at a time
+        return discord.FFmpegOpusAudio(
+            pipe,
+            pipe=True,
+            bitrate=bitrate,
+            before_options="-f s16le -ar 44100 -ac 2 -re",
+            options="-page_duration 20000",
+        )
+    return ResampledPCMAudio(pipe)
+
+
+class SendTimer:
+    """
+    Times how long a voice client takes to send each frame. For PCM sources this includes 
+    discord.py encoding the frame to Opus in the voice thread. Replaces the voice client's 
+    `send_audio_packet` with a timed version, which the voice client's player picks up the next 
+    time it plays something
+
+    :ivar frames: The number of frames sent since the timer was attached
+    """
+
+    def __init__(self, voice_client: discord.VoiceClient, window: int = SEND_TIME_WINDOW) -> None:
+        self.voice_client = voice_client
+        self.frames = 0
+        self._times: deque[float] = deque(maxlen=window)
+        send_audio_packet = voice_client.send_audio_packet
+
+        def timed_send_audio_packet(data: bytes, *, encode: bool = True):
+            start = time.perf_counter()
+            send_audio_packet(data, encode=encode)
+            self._times.append(time.perf_counter() - start)
+            self.frames += 1
+
+        voice_client.send_audio_packet = timed_send_audio_packet
+
+    def stats(self) -> dict[str, float]:
+        """ :returns: The mean, 95th percentile and slowest send time in milliseconds over the last `window` frames """
+        times = np.array(self._times) * 1000
+        if times.size == 0:
+            return {"frames": self.frames, "mean_ms": 0.0, "p95_ms": 0.0, "max_ms": 0.0}
+        return {
+            "frames": self.frames,
+            "mean_ms": float(times.mean()),
+            "p95_ms": float(np.percentile(times, 95)),
+            "max_ms": float(times.max()),
+        }
+
+
+class Broadcast:
+    """
+    Plays one `AudioSource` to any number of voice clients. A thread reads the source in real 
+    time and Opus encodes each frame once, unless the source is already Opus, then hands the 
+    encoded frame to every subscriber. Handing off never blocks, so a slow voice connection only 
+    loses its own frames. See `BroadcastSubscriber`
+
+    :param source: The audio to broadcast, such as from `create_music_source`
+    :param bitrate: The Opus bitrate in kbps to encode PCM sources at
+    """
+
+    def __init__(self, source: discord.AudioSource, bitrate: int = 128) -> None:
+        self.source = source
+        self.encoder = None if source.is_opus() else OpusEncoder(bitrate=bitrate)
+        self.frames = 0
+        self._subscribers: set[BroadcastSubscriber] = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="broadcast", daemon=True)
+        self._thread.start()
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            subscribers = tuple(self._subscribers)
+        return {
+            "subscribers": len(subscribers),
+            "frames": self.frames,
+            "dropped_frames": sum(subscriber.dropped_frames for subscriber in subscribers),
+        }
+
+    def is_running(self) -> bool:
+        return not self._stopped.is_set()
+
+    def subscribe(self, max_frames: int = BROADCAST_QUEUE_FRAMES) -> "BroadcastSubscriber":
+        """
+        :returns: An `AudioSource` for a voice client to play. It ends when the broadcast does
+        """
+        subscriber = BroadcastSubscriber(self, max_frames)
+        with self._lock:
+            if self.is_running():
+                self._subscribers.add(subscriber)
+            else:
+                subscriber.end()
+        return subscriber
+
+    def unsubscribe(self, subscriber: "BroadcastSubscriber"):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        delay = OpusEncoder.FRAME_LENGTH / 1000
+        next_time = time.perf_counter()
+        try:
+            while not self._stopped.is_set():
+                packet = self.source.read()
+                if not packet:
+                    break
+                if self.encoder is not None:
+                    if len(packet) < OpusEncoder.FRAME_SIZE:
+                        packet += bytes(OpusEncoder.FRAME_SIZE - len(packet))
+                    packet = self.encoder.encode(packet, OpusEncoder.SAMPLES_PER_FRAME)
+                self.frames += 1
+
+                with self._lock:
+                    subscribers = tuple(self._subscribers)
+                for subscriber in subscribers:
+                    subscriber.push(packet)
+
+                # Keep to real time like discord's own player does, since the source never waits
+                next_time += delay
+                time.sleep(max(0.0, next_time - time.perf_counter()))
+        except Exception as e:
+            print(f"Broadcast stopped because of `{e}`")
+        finally:
+            with self._lock:
+                self._stopped.set()
+                subscribers = tuple(self._subscribers)
+                self._subscribers.clear()
+            for subscriber in subscribers:
+                subscriber.end()
+            self.source.cleanup()
+
+
+class BroadcastSubscriber(discord.AudioSource):
+    """
+    One voice client's share of a `Broadcast`. Encoded frames wait in a queue of at most 
+    `max_frames`. If the voice client falls that far behind, the oldest frames are dropped rather 
+    than holding up the broadcast. If no frame has arrived in time, silence is sent instead
+
+    :ivar dropped_frames: The number of frames dropped because the queue was full
+    """
+
+    def __init__(self, broadcast: Broadcast, max_frames: int) -> None:
+        self.broadcast = broadcast
+        self.dropped_frames = 0
+        self._frames: deque[bytes] = deque(maxlen=max_frames)
+        self._ended = False
+        self._ready = threading.Condition()
+
+    def push(self, packet: bytes):
+        with self._ready:
+            if len(self._frames) == self._frames.maxlen:
+                self.dropped_frames += 1
+            self._frames.append(packet)
+            self._ready.notify()
+
+    def end(self):
+        with self._ready:
+            self._ended = True
+            self._ready.notify()
+
+    def read(self) -> bytes:
+        with self._ready:
+            if not self._frames and not self._ended:
+                self._ready.wait(BROADCAST_READ_TIMEOUT)
+            if self._frames:
+                return self._frames.popleft()
+            if self._ended:
+                return b""
+            return OPUS_SILENCE
+
+    def is_opus(self) -> bool:
+        return True
+
+    def cleanup(self):
+        self.broadcast.unsubscribe(self)
+
+
+class MixerClip:
+    """
+    A clip playing in a `Mixer`. Opus clips are decoded to PCM as they are read
+    """
+
+    def __init__(self, source: discord.AudioSource) -> None:
+        self.source = source
+        self.decoder = OpusDecoder() if source.is_opus() else None
+
+    def read(self) -> bytes:
+        frame = self.source.read()
+        if frame and self.decoder is not None:
+            frame = self.decoder.decode(frame)
+        return frame
+
+
+class Mixer(discord.AudioSource):
+    """
+    Plays clips over music. Each frame, the music and every playing clip are summed in one numpy 
+    buffer, which is clipped to the 16 bit range so loud overlaps distort rather than wrap around. 
+    While clips are playing, the music is ducked to `duck_gain`, ramping over a few frames so the 
+    change does not click. Clips can be added from any thread while the mixer is playing
+
+    Mixing costs a decode and an encode per frame, so the mixer should only play while clips do. 
+    Once the last clip has ended and the music is back at full volume, the music is handed to 
+    `on_unmixed`, which should put it back on the voice client in place of the mixer. That frame 
+    is returned in the music's own format, Opus or PCM, to match. After that the mixer takes no 
+    more clips. Without `on_unmixed`, music frames pass through decoded while no clips play
+
+    While the music is paused with `pause_music`, it is not read at all, so its own buffer stays 
+    paused too, and clips play over silence. If it is still paused when it is handed back, the 
+    mixer returns a frame of silence instead, and `on_unmixed` should pause the voice client
+
+    :param music: The music to play clips over, or None to play only clips. An Opus source, such 
+        as a `BroadcastSubscriber`, is decoded to PCM
+    :param duck_gain: How loud the music is while clips are playing
+    :param on_unmixed: Called from the voice thread with the music and whether it is paused, once 
+        nothing is left to mix
+    :ivar clipped_samples: The number of samples clipped since the mixer started
+    """
+
+    def __init__(
+        self,
+        music: discord.AudioSource | None = None,
+        duck_gain: float = MIXER_DUCK_GAIN,
+        on_unmixed: Callable[[discord.AudioSource, bool], None] | None = None,
+    ) -> None:
+        self.music = music
+        self.duck_gain = duck_gain
+        self.on_unmixed = on_unmixed
+        self.is_unmixed = False
+        self._music_paused = False
+        self.clipped_samples = 0
+        self.mixed_frames = 0
+        self._music_decoder = OpusDecoder() if music is not None and music.is_opus() else None
+        self._clips: list[MixerClip] = []
+        self._lock = threading.Lock()
+        self._gain = 1.0
+        self._ramp = np.linspace(0, 1, OUTPUT_FRAME_SAMPLES, endpoint=False, dtype=np.float32).repeat(CHANNELS)
+        self._gains = np.empty(OUTPUT_FRAME_SAMPLES * CHANNELS, dtype=np.float32)
+        self._mix = np.empty(OUTPUT_FRAME_SAMPLES * CHANNELS, dtype=np.float32)
+        self._output = np.empty(OUTPUT_FRAME_SAMPLES * CHANNELS, dtype="<i2")
+
+    def add(self, source: discord.AudioSource) -> bool:
+        """
+        Starts playing a clip over whatever else is playing.
+
+        :param source: The clip, either Opus or 48 kHz stereo PCM in 20 ms frames
+        :returns: False if the mixer has already handed its music back. See `on_unmixed`
+        """
+        with self._lock:
+            if self.is_unmixed:
+                return False
+            self._clips.append(MixerClip(source))
+            return True
+
+    def clips(self) -> int:
+        with self._lock:
+            return len(self._clips)
+
+    def pause_music(self):
+        """ Stops reading the music, while clips carry on """
+        with self._lock:
+            self._music_paused = True
+
+    def resume_music(self):
+        with self._lock:
+            self._music_paused = False
+
+    def is_music_paused(self) -> bool:
+        return self._music_paused
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "clips": self.clips(),
+            "mixed_frames": self.mixed_frames,
+            "clipped_samples": self.clipped_samples,
+            "music_gain": round(self._gain, 3),
+        }
+
+    def read(self) -> bytes:
+        with self._lock:
+            music_paused = self._music_paused
+            if not self._clips and (self._gain == 1.0 or music_paused) and self.music is not None and self.on_unmixed is not None:
+                # Handing back under the lock means `add` cannot slip a clip in that would never play
+                music, self.music = self.music, None
+                self.is_unmixed = True
+                self.on_unmixed(music, music_paused)
+                if music_paused:
+                    return OPUS_SILENCE if music.is_opus() else bytes(OUTPUT_FRAME_BYTES)
+                return music.read()
+
+        music = b"" if music_paused else self._read_music()
+        with self._lock:
+            clips = tuple(self._clips)
+
+        target_gain = self.duck_gain if clips else 1.0
+        if not clips and music_paused and self.music is not None:
+            return bytes(OUTPUT_FRAME_BYTES)
+        if not clips and self._gain == 1.0:
+            return music or b""
+        if not clips and not music:
+            return b""
+
+        self._ramp_gain(target_gain)
+        if music:
+            np.multiply(np.frombuffer(_pad_frame(music), dtype="<i2"), self._gains, out=self._mix)
+        else:
+            self._mix.fill(0)
+
+        finished = []
+        for clip in clips:
+            frame = clip.read()
+            if not frame:
+                finished.append(clip)
+                continue
+            np.add(self._mix, np.frombuffer(_pad_frame(frame), dtype="<i2"), out=self._mix)
+        if finished:
+            with self._lock:
+                self._clips = [clip for clip in self._clips if clip not in finished]
+                ended = self.music is None and not self._clips
+            for clip in finished:
+                clip.source.cleanup()
+            if ended:
+                return b""
+
+        self.clipped_samples += int(np.count_nonzero((self._mix > MAX_SAMPLE) | (self._mix < MIN_SAMPLE)))
+        np.clip(self._mix, MIN_SAMPLE, MAX_SAMPLE, out=self._mix)
+        np.copyto(self._output, self._mix, casting="unsafe")
+        self.mixed_frames += 1
+        return self._output.tobytes()
+
+    def _read_music(self) -> bytes:
+        if self.music is None:
+            return b""
+        frame = self.music.read()
+        if not frame:
+            # Clips that are still playing carry on without the music
+            self.music.cleanup()
+            self.music = None
+            return b""
+        if self._music_decoder is not None:
+            frame = self._music_decoder.decode(frame)
+        return frame
+
+    def _ramp_gain(self, target_gain: float):
+        """
+        Fills `_gains` with the music's gain for each sample of this frame, moving a step of the 
+        way from the current gain to `target_gain`.
+        """
+        step = (1.0 - self.duck_gain) / MIXER_DUCK_FRAMES or 1.0
+        if self._gain < target_gain:
+            next_gain = min(self._gain + step, target_gain)
+        else:
+            next_gain = max(self._gain - step, target_gain)
+        np.multiply(self._ramp, next_gain - self._gain, out=self._gains)
+        np.add(self._gains, self._gain, out=self._gains)
+        self._gain = next_gain
+
+    def is_opus(self) -> bool:
+        return False
+
+    def cleanup(self):
+        with self._lock:
+            clips, self._clips = self._clips, []
+        for clip in clips:
+            clip.source.cleanup()
+        if self.music is not None:
+            self.music.cleanup()
+            self.music = None
+
+
+def _pad_frame(frame: bytes) -> bytes:
+    if len(frame) < OUTPUT_FRAME_BYTES:
+        return frame + bytes(OUTPUT_FRAME_BYTES - len(frame))
+    return frame[:OUTPUT_FRAME_BYTES]
@@ -28,7 +28,8 @@ def refresh_token_helper(refresh_token: str):
     if 300 > response.status_code >= 200:
         body = json.loads(response.text)
         os.environ["SPOTIFY_ACCESS_TOKEN"] = body["access_token"]
-        return {"access_token": body["access_token"]}, 200
+        os.environ["SPOTIFY_TOKEN_EXPIRES_AT"] = str(time.time() + body["expires_in"])
+        return {"access_token": body["access_token"], "expires_in": body["expires_in"]}, 200
     
     print(f"refresh_token failed with code {response.status_code} and text {response.text}")
     return {}
@@ -104,6 +105,7 @@ def callback():
         print(body)
         os.environ["SPOTIFY_ACCESS_TOKEN"] = body["access_token"]
         os.environ["SPOTIFY_REFRESH_TOKEN"] = body["refresh_token"]
+        os.environ["SPOTIFY_TOKEN_EXPIRES_AT"] = str(time.time() + body["expires_in"])
         clean_thread = threading.Thread(target=clean_old_token, args=(body["expires_in"] - 10,))
         clean_thread.start()
         return "Login Successful", 200
@@ -115,13 +117,14 @@ def callback():
 def access_token(state: str):
     """
     First verifies that the request is coming from a valid client by checking the `state` argument. 
-    Then responds with json containing {"access_token": "abcd", "refresh_token": "efgh"}
+    Then responds with json containing {"access_token": "abcd", "refresh_token": "efgh", "expires_in": 3600}
 
     # Required Positional Args
     * state - A token that indicates the request is coming from a valid client
 
     # Returns 
-    If all goes well, responds with a json object containing the keys "access_token" and "refresh_token"
+    If all goes well, responds with a json object containing the keys "access_token" and "refresh_token". 
+    If the lifetime of the access token is known, "expires_in" holds the number of seconds it has left
 
     # Errors 
     * 500 - If no security token has been set in the environment
@@ -135,10 +138,13 @@ def access_token(state: str):
         return {"error": "Received bad state"}, 401
 
     if request.method == "GET":
-        return {
+        body = {
             "access_token": os.getenv("SPOTIFY_ACCESS_TOKEN"), 
             "refresh_token": os.getenv("SPOTIFY_REFRESH_TOKEN"),
-        }, 200
+        }
+        if os.getenv("SPOTIFY_TOKEN_EXPIRES_AT") is not None:
+            body["expires_in"] = max(0, int(float(os.getenv("SPOTIFY_TOKEN_EXPIRES_AT")) - time.time()))
+        return body, 200
     
     elif request.method == "DELETE": 
         status = 204
@@ -150,6 +156,9 @@ def access_token(state: str):
         if os.getenv("SPOTIFY_REFRESH_TOKEN") is not None:
             del os.environ["SPOTIFY_REFRESH_TOKEN"]
 
+        if os.getenv("SPOTIFY_TOKEN_EXPIRES_AT") is not None:
+            del os.environ["SPOTIFY_TOKEN_EXPIRES_AT"]
+
         return {"status": status}, status
 
 
@@ -0,0 +1,75 @@
+"""
+Compares the in-process resampler with the ffmpeg resampler that music used to play through.
+Both are fed the same 44.1 kHz PCM from a pipe, the way librespot feeds them, and read 20 ms
+frames as fast as they come. Reports time to the first frame and the CPU used per second of
+audio, counting the ffmpeg process for the ffmpeg source. Needs ffmpeg on the PATH.
+
+Run from the repository root with `python -m benchmarks.bench_audio_source`
+"""
+import os
+import resource
+import threading
+import time
+
+import discord
+import numpy as np
+
+import audio
+
+
+SECONDS = 30
+
+
+def make_pcm(seconds: int) -> bytes:
+    t = np.arange(audio.INPUT_RATE * seconds) / audio.INPUT_RATE
+    tone = (np.sin(2 * np.pi * 440 * t) * 10000).astype("<i2")
+    return np.repeat(tone[:, np.newaxis], audio.CHANNELS, axis=1).tobytes()
+
+
+def cpu_seconds() -> float:
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def bench(name: str, make_source, pcm: bytes):
+    read_fd, write_fd = os.pipe()
+    pipe = open(read_fd, "rb")
+
+    def feed():
+        with open(write_fd, "wb") as writer:
+            writer.write(pcm)
+
+    feeder = threading.Thread(target=feed)
+    cpu_start = cpu_seconds()
+    start = time.perf_counter()
+    feeder.start()
+    source = make_source(pipe)
+
+    first_frame = None
+    frames = 0
+    while True:
+        frame = source.read()
+        if not frame:
+            break
+        if first_frame is None:
+            first_frame = time.perf_counter() - start
+        frames += 1
+
+    source.cleanup()
+    feeder.join()
+    pipe.close()
+    cpu = cpu_seconds() - cpu_start
+    audio_seconds = frames / 50
+    print(f"{name:<8} first frame {first_frame * 1000:7.2f} ms   {cpu / audio_seconds * 1000:6.2f} ms CPU per second of audio   ({frames} frames)")
+
+
+if __name__ == "__main__":
+    pcm = make_pcm(SECONDS)
+    bench("python", audio.ResampledPCMAudio, pcm)
+    bench("ffmpeg", lambda pipe: discord.FFmpegPCMAudio(
+        pipe=True,
+        source=pipe,
+        before_options="-f s16le -ar 44100 -ac 2",
+        options="-f s16le -ar 48000 -ac 2",
+    ), pcm)
@@ -0,0 +1,65 @@
+"""
+Measures how long it takes to parse the Spotify objects the bot sees most often into models.
+
+Run from the repository root with `python -m benchmarks.bench_models`
+"""
+import timeit
+
+import spotify_controller
+
+
+TRACK = {
+    "type": "track",
+    "name": "Never Gonna Give You Up",
+    "uri": "spotify:track:4PTG3Z6ehGkBFwjybzWkR8",
+    "duration_ms": 213573,
+    "external_urls": {"spotify": "https://open.spotify.com/track/4PTG3Z6ehGkBFwjybzWkR8"},
+    "artists": [
+        {
+            "type": "artist",
+            "name": "Rick Astley",
+            "id": "0gxyHStUsqpMadRV0Di1Qt",
+            "uri": "spotify:artist:0gxyHStUsqpMadRV0Di1Qt",
+            "href": "https://api.spotify.com/v1/artists/0gxyHStUsqpMadRV0Di1Qt",
+            "external_urls": {"spotify": "https://open.spotify.com/artist/0gxyHStUsqpMadRV0Di1Qt"},
+        },
+    ],
+    "album": {
+        "type": "album",
+        "name": "Whenever You Need Somebody",
+        "images": [
+            {"url": "https://i.scdn.co/image/ab67616d0000b273", "height": 640, "width": 640},
+            {"url": "https://i.scdn.co/image/ab67616d00001e02", "height": 300, "width": 300},
+        ],
+    },
+    "available_markets": ["US", "CA", "GB", "DE", "FR"] * 36,
+    "disc_number": 1,
+    "explicit": False,
+    "popularity": 80,
+    "track_number": 1,
+}
+
+EPISODE = {
+    "type": "episode",
+    "name": "Episode 1",
+    "uri": "spotify:episode:512ojhOuo1ktJprKbVcKyQ",
+    "duration_ms": 3600000,
+    "external_urls": {"spotify": "https://open.spotify.com/episode/512ojhOuo1ktJprKbVcKyQ"},
+    "images": [{"url": "https://i.scdn.co/image/ab6765630000ba8a", "height": 640, "width": 640}],
+    "show": {
+        "type": "show",
+        "name": "A Podcast",
+        "external_urls": {"spotify": "https://open.spotify.com/show/38bS44xjbVVZ3No3ByF1dJ"},
+    },
+    "description": "A long description " * 50,
+}
+
+
+def bench(name: str, spotify_object: dict, number: int = 100_000):
+    seconds = min(timeit.repeat(lambda: spotify_controller.Queueable(spotify_object), number=number, repeat=5))
+    print(f"{name:<8} {seconds / number * 1e6:.2f} µs per item")
+
+
+if __name__ == "__main__":
+    bench("track", TRACK)
+    bench("episode", EPISODE)
@@ -4,11 +4,201 @@ import os
 import urllib.parse
 import urllib.parse
 
+import audio
 import spotify_controller
+from voice import voice_connections
+import asyncio
+from collections import deque
+import itertools
 import time
 from rapidfuzz import fuzz
 
 
+# How many items from a guild's queue are handed to Spotify ahead of time 
+SPOTIFY_LOOKAHEAD = 2
+
+# How many previously played items each guild remembers 
+HISTORY_LENGTH = 50
+
+# How often, in seconds, a guild queue checks what Spotify is playing so it can hand over more items
+QUEUE_POLL_INTERVAL = 5
+
+
+class GuildQueue:
+    """
+    The queue for a single guild, kept by the bot rather than by Spotify. Only the first 
+    `SPOTIFY_LOOKAHEAD` items are handed to Spotify. Everything behind them can be cleared, 
+    removed, or reordered without making any requests to Spotify 
+    """
+
+    def __init__(self) -> None:
+        self.current: spotify_controller.Queueable | None = None
+        self.sent: deque[spotify_controller.Queueable] = deque()
+        self.upcoming: deque[spotify_controller.Queueable] = deque()
+        self.history: deque[spotify_controller.Queueable] = deque(maxlen=HISTORY_LENGTH)
+        self.follow_task: asyncio.Task | None = None
+        self._sync_lock = asyncio.Lock()
+
+    def __len__(self) -> int:
+        return len(self.sent) + len(self.upcoming)
+
+    def items(self) -> list[spotify_controller.Queueable]:
+        """ Everything still to play, in order. The first `len(self.sent)` items are already with Spotify """
+        return [*self.sent, *self.upcoming]
+
+    async def add(self, tracks: list[spotify_controller.Queueable]):
+        """
+        Adds items to the end of the queue and tops up Spotify's queue if there is room 
+
+        :raises ControllerError: If Spotify refuses the items handed to it
+        """
+        self.upcoming.extend(tracks)
+        await self.sync()
+        if self.follow_task is None:
+            self.follow_task = asyncio.create_task(self._follow())
+
+    def clear(self) -> int:
+        """
+        Removes everything that has not been handed to Spotify yet 
+
+        :returns: The number of items removed
+        """
+        removed = len(self.upcoming)
+        self.upcoming.clear()
+        return removed
+
+    def remove(self, position: int) -> spotify_controller.Queueable:
+        """
+        :param position: 1-based position in `items()` 
+        :raises IndexError: If nothing is at `position`, or the item there is already with Spotify
+        """
+        index = self._upcoming_index(position)
+        track = self.upcoming[index]
+        del self.upcoming[index]
+        return track
+
+    def move(self, source: int, destination: int) -> spotify_controller.Queueable:
+        """
+        :param source: 1-based position in `items()` of the item to move 
+        :param destination: 1-based position in `items()` to move it to 
+        :raises IndexError: If either position is out of range or already with Spotify
+        """
+        source_index = self._upcoming_index(source)
+        destination_index = self._upcoming_index(destination)
+        track = self.upcoming[source_index]
+        del self.upcoming[source_index]
+        self.upcoming.insert(destination_index, track)
+        return track
+
+    def _upcoming_index(self, position: int) -> int:
+        if position < 1 or position > len(self):
+            raise IndexError(f"There is nothing at position {position} in the queue")
+        if position <= len(self.sent):
+            raise IndexError(f"Position {position} has already been handed to Spotify")
+        return position - 1 - len(self.sent)
+
+    async def sync(self):
+        """
+        Works out which of the items handed to Spotify have been played, then hands over more 
+        items until Spotify holds `SPOTIFY_LOOKAHEAD` of them. Items Spotify no longer has queued 
+        count as played even if they were skipped before the bot saw them, so the queue keeps 
+        moving when someone skips ahead or plays something else in the Spotify app
+        """
+        async with self._sync_lock:
+            if self.sent:
+                snapshot = await spotify_controller.get_playback_snapshot()
+                now_playing = snapshot.now_playing
+                current_uri = self.current.uri if self.current else None
+                if now_playing is not None and now_playing.uri != current_uri and any(track.uri == now_playing.uri for track in self.sent):
+                    while self.sent:
+                        self._finish_current()
+                        self.current = self.sent.popleft()
+                        if self.current.uri == now_playing.uri:
+                            break
+
+                # Items queued by hand play before the context, so anything the bot handed over 
+                # that is still waiting shows up at the front of Spotify's queue
+                queued_uris = [track.uri for track in snapshot.queue]
+                played = []
+                while self.sent and self.sent[0].uri not in queued_uris:
+                    played.append(self.sent.popleft())
+                if played:
+                    if now_playing is None or self.current is None or now_playing.uri != self.current.uri:
+                        self._finish_current()
+                    self.history.extend(played)
+
+            batch = list(itertools.islice(self.upcoming, max(0, SPOTIFY_LOOKAHEAD - len(self.sent))))
+
+            async def handed_over(queued: int, total: int):
+                track = batch[queued - 1]
+                if track in self.upcoming:
+                    self.upcoming.remove(track)
+                self.sent.append(track)
+
+            if batch:
+                await spotify_controller.add_many_to_queue([track.uri for track in batch], on_progress=handed_over)
+
+    def _finish_current(self):
+        if self.current is not None:
+            self.history.append(self.current)
+            self.current = None
+
+    async def _follow(self):
+        """ Keeps calling `sync` for as long as there is anything left in the queue """
+        try:
+            while len(self) > 0:
+                await asyncio.sleep(QUEUE_POLL_INTERVAL)
+                try:
+                    await self.sync()
+                except spotify_controller.ControllerError as e:
+                    print(f"GuildQueue failed to sync with Spotify due to `{e}`")
+        finally:
+            self.follow_task = None
+
+
+def get_guild_queue(ctx) -> GuildQueue:
+    return ctx.bot.get_cog("Music").get_queue(ctx.guild.id)
+
+
+def is_music_playing(voice_client: discord.VoiceClient) -> bool:
+    """ Whether music is playing, which a soundboard clip playing over paused music does not count as """
+    if not voice_client.is_playing():
+        return False
+    source = voice_client.source
+    return not (isinstance(source, audio.Mixer) and source.is_music_paused())
+
+
+def is_music_paused(voice_client: discord.VoiceClient) -> bool:
+    source = voice_client.source
+    return voice_client.is_paused() or (isinstance(source, audio.Mixer) and source.is_music_paused())
+
+
+def pause_voice(voice_client: discord.VoiceClient):
+    """
+    Pauses the voice client and drops the audio librespot has already sent, so it is not played 
+    late when playback resumes. If soundboard clips are playing over the music, only the music is 
+    paused and the clips carry on
+    """
+    source = voice_client.source
+    if isinstance(source, audio.Mixer) and voice_client.is_playing():
+        source.pause_music()
+    else:
+        voice_client.pause()
+    librespot_audio = spotify_controller.get_librespot_audio(voice_client.guild.id)
+    if librespot_audio:
+        librespot_audio.pause()
+
+
+def resume_voice(voice_client: discord.VoiceClient):
+    librespot_audio = spotify_controller.get_librespot_audio(voice_client.guild.id)
+    if librespot_audio:
+        librespot_audio.resume()
+    source = voice_client.source
+    if isinstance(source, audio.Mixer):
+        source.resume_music()
+    voice_client.resume()
+
+
 class SearchModal(discord.ui.Modal, title="Song Search"):
     def __init__(self, ctx) -> None:
         super().__init__()
@@ -77,7 +267,7 @@ class SearchModal(discord.ui.Modal, title="Song Search"):
 
         raw_results = None
         try:
-            raw_results = spotify_controller.search(query=query, limit=limit, search_type=search_types)
+            raw_results = await spotify_controller.search(query=query, limit=limit, search_type=search_types)
         except Exception as e:
             await self.ctx.send(f"Failed to execute search due to error: ```{e}```")
             return 
@@ -85,6 +275,16 @@ class SearchModal(discord.ui.Modal, title="Song Search"):
         search_results: list[spotify_controller.Queueable | spotify_controller.Collection] = []
         print(f"search_types: {search_types}")
         print("raw results:", raw_results)
+
+        # Search results only include simplified episodes, so look up the full objects all at once
+        episodes = {}
+        if "episode" in search_types:
+            episode_ids = [item["id"] for item in raw_results["episodes"]["items"] if item is not None]
+            try: 
+                episodes = await spotify_controller.get_episodes(episode_ids)
+            except Exception as e:
+                print(f"Failed to get episode info with error `{e}`")
+
         for search_t in search_types:
             for item in raw_results[f"{search_t}s"]["items"]:
                 if search_t == "track":
@@ -94,14 +294,10 @@ class SearchModal(discord.ui.Modal, title="Song Search"):
                         print(f"Failed to create Queueable from track info because of `{e}`")
                         continue
                 elif search_t == "episode": 
-                    episode = None
-                    try: 
-                        episode = spotify_controller.get_episode(item["id"])
-                    except Exception as e:
-                        print(f"Failed to get episode info with error `{e}`")
+                    if item is None or item["id"] not in episodes:
                         continue
                     try: 
-                        search_results.append(spotify_controller.Queueable(episode))
+                        search_results.append(spotify_controller.Queueable(episodes[item["id"]]))
                     except Exception as e:
                         print(f"Failed to create Queueable from episode info due to `{e}`")
                 elif search_t in ("playlist", "album"): 
@@ -114,17 +310,11 @@ class SearchModal(discord.ui.Modal, title="Song Search"):
         if auto_queue:
             best_match = self.fuzzyfind(query=query, pool=search_results)
             if isinstance(best_match, spotify_controller.Collection):
-                for track in best_match.tracks:
-                    try: 
-                        headers = spotify_controller.get_spotify_headers()
-                        spotify_controller.add_to_queue(track.uri, headers=headers)
-                    except Exception as e:
-                        await self.ctx.send(f"Encountered error while queueing your collection: ```{e}```")
-                        return 
-                await self.ctx.send(f"Queued \"{best_match.name}\" by {best_match.artists[0].name}")
+                if not await queue_collection(self.ctx, best_match):
+                    return 
             elif isinstance(best_match, spotify_controller.Queueable):
                 try:
-                    spotify_controller.add_to_queue(best_match.uri)
+                    await get_guild_queue(self.ctx).add([best_match])
                 except spotify_controller.ControllerError as e: 
                     await self.ctx.send(f"Encountered error while queueing your track: ```{e}```")
                     return 
@@ -157,7 +347,7 @@ class PlaybackView(discord.ui.View):
         self.add_item(SkipBackButton(ctx))
         is_playing = False
         if ctx.guild.voice_client:
-            is_playing = ctx.guild.voice_client.is_playing()
+            is_playing = is_music_playing(ctx.guild.voice_client)
 
         self.add_item(TogglePlayButton(ctx, is_playing))
         self.add_item(SkipForwardButton(ctx))
@@ -176,8 +366,8 @@ async def create_playback_embed(ctx) -> tuple[discord.Embed, PlaybackView]:
     and skip
     """
 
-    now_playing = spotify_controller.get_now_playing()
-    queue = spotify_controller.get_queue()
+    snapshot = await spotify_controller.get_playback_snapshot()
+    queue = get_guild_queue(ctx).items()
     queue_str = ""
     if len(queue) <= 8:
         queue_str += "\n".join([f"{i + 1}. {track.discord_display_str()}" for i, track in enumerate(queue[:6])])
@@ -189,12 +379,47 @@ async def create_playback_embed(ctx) -> tuple[discord.Embed, PlaybackView]:
 
     view = PlaybackView(ctx)
     embed = discord.Embed(title="Playback", color=discord.Color.blurple())
-    embed.set_thumbnail(url=now_playing.image)
-    embed.add_field(name="Now Playing", value=now_playing.discord_display_str(), inline=False)
+    if snapshot.now_playing is not None:
+        embed.set_thumbnail(url=snapshot.now_playing.image)
+        embed.add_field(name="Now Playing", value=snapshot.now_playing.discord_display_str(), inline=False)
+    else:
+        embed.add_field(name="Now Playing", value="Nothing", inline=False)
     embed.add_field(name="Up Next", value=queue_str, inline=False)
     return (embed, view)
 
 
+async def queue_collection(ctx, collection: spotify_controller.Collection) -> bool:
+    """
+    Adds every track in an album or playlist to the guild's queue, one page at a time as the pages 
+    arrive from Spotify, and reports progress by editing a single message
+
+    :param ctx: The current discord client context 
+    :param collection: The album or playlist to queue 
+    :returns: `True` if every track was queued. `False` if queueing stopped early because of an error
+    """
+
+    title = f"\"{collection.name}\" by {collection.artists[0].name}"
+    total = collection.total_tracks if collection.total_tracks is not None else "?"
+    message = await ctx.send(f"Queueing {title}: 0/{total}")
+    last_edit = time.monotonic()
+    queued = 0
+
+    try:
+        async for page in collection.iter_track_pages():
+            await get_guild_queue(ctx).add(page)
+            queued += len(page)
+            # Discord rate limits message edits, so only show progress about once a second
+            if time.monotonic() - last_edit >= 1:
+                last_edit = time.monotonic()
+                await message.edit(content=f"Queueing {title}: {queued}/{total}")
+    except spotify_controller.ControllerError as e:
+        await message.edit(content=f"Encountered error while queueing your collection: ```{e}```")
+        return False
+
+    await message.edit(content=f"Queued {title}")
+    return True
+
+
 class SkipBackButton(discord.ui.Button):
     def __init__(self, ctx):
         super().__init__(emoji="⏪", style=discord.ButtonStyle.primary, custom_id="rewind")
@@ -202,8 +427,8 @@ class SkipBackButton(discord.ui.Button):
 
     async def callback(self, interaction: discord.Interaction):
         voice_client = self.ctx.guild.voice_client
-        if voice_client and voice_client.is_playing() and not voice_client.is_paused():
-            spotify_controller.skip("previous")
+        if voice_client and is_music_playing(voice_client):
+            await spotify_controller.skip("previous")
             embed, view = await create_playback_embed(self.ctx)
             await interaction.response.edit_message(embed=embed, view=view)
         else:
@@ -221,16 +446,16 @@ class TogglePlayButton(discord.ui.Button):
 
     async def callback(self, interaction: discord.Interaction):
         voice_client = self.ctx.guild.voice_client
-        if not spotify_controller.is_playing() and voice_client and voice_client.is_paused():
-            voice_client.resume()
-            spotify_controller.play()
+        if not await spotify_controller.is_playing() and voice_client and is_music_paused(voice_client):
+            resume_voice(voice_client)
+            await spotify_controller.play()
             
             embed, view = await create_playback_embed(self.ctx)
             await interaction.response.edit_message(embed=embed, view=view)
 
-        elif spotify_controller.is_playing() and voice_client and voice_client.is_playing(): 
-            spotify_controller.pause()
-            voice_client.pause()
+        elif await spotify_controller.is_playing() and voice_client and is_music_playing(voice_client): 
+            await spotify_controller.pause()
+            pause_voice(voice_client)
             embed, view = await create_playback_embed(self.ctx)
             await interaction.response.edit_message(embed=embed, view=view)
 
@@ -245,8 +470,8 @@ class SkipForwardButton(discord.ui.Button):
 
     async def callback(self, interaction: discord.Interaction):
         voice_client = self.ctx.guild.voice_client
-        if voice_client and voice_client.is_playing() and not voice_client.is_paused():
-            spotify_controller.skip("next")
+        if voice_client and is_music_playing(voice_client):
+            await spotify_controller.skip("next")
             embed, view = await create_playback_embed(self.ctx)
             await interaction.response.edit_message(embed=embed, view=view)
         else:
@@ -265,7 +490,7 @@ class StopButton(discord.ui.Button):
                 voice_client.stop()
 
             await voice_client.disconnect()
-            spotify_controller.stop_librespot()
+            await self.ctx.bot.get_cog("Music").end_voice_session(self.ctx.guild.id)
             await interaction.response.send_message(content="Disconnected")
 
 
@@ -286,7 +511,7 @@ class ClearQueueButton(discord.ui.Button):
 
     async def callback(self, interaction: discord.Interaction):
         await interaction.response.defer()
-        spotify_controller.clear_queue()
+        get_guild_queue(self.ctx).clear()
         embed, view = await create_playback_embed(self.ctx)
         await self.ctx.send(embed=embed, view=view)
 
@@ -307,18 +532,12 @@ class SearchResultButton(discord.ui.Button):
     async def callback(self, interaction: discord.Interaction):
         if isinstance(self.resource, spotify_controller.Collection):
             await interaction.response.defer()
-            for track in self.resource.tracks:
-                try: 
-                    headers = spotify_controller.get_spotify_headers()
-                    spotify_controller.add_to_queue(track.uri, headers=headers)
-                except Exception as e:
-                    await self.ctx.send(f"Encountered error while queueing your collection: ```{e}```")
-                    return 
-            await self.ctx.send(f"Queued \"{self.resource.name}\" by {self.resource.artists[0].name}")
+            if not await queue_collection(self.ctx, self.resource):
+                return 
         elif isinstance(self.resource, spotify_controller.Queueable):
             await interaction.response.defer()
             try:
-                spotify_controller.add_to_queue(self.resource.uri)
+                await get_guild_queue(self.ctx).add([self.resource])
             except spotify_controller.ControllerError as e: 
                 await self.ctx.send(f"Encountered error while queueing your track: ```{e}```")
                 return 
@@ -339,6 +558,123 @@ class Music(commands.Cog):
         - bot (commands.Bot): The bot instance to which the cog will be added.
         """
         self.bot = bot
+        self.queues: dict[int, GuildQueue] = {}
+        # Shared listening streams, keyed by the id of the guild whose librespot is broadcast
+        self.broadcasts: dict[int, audio.Broadcast] = {}
+        self.send_timers: dict[int, audio.SendTimer] = {}
+
+    async def cog_unload(self):
+        """
+        Stops following playback for every guild and closes the pooled HTTP session used to talk 
+        to Spotify when the cog is unloaded.
+        """
+        for queue in self.queues.values():
+            if queue.follow_task is not None:
+                queue.follow_task.cancel()
+        for broadcast in self.broadcasts.values():
+            broadcast.stop()
+        await spotify_controller.close_session()
+
+    def get_queue(self, guild_id: int) -> GuildQueue:
+        """
+        Returns the queue for a guild, creating an empty one the first time it is asked for.
+
+        Parameters:
+        - guild_id (int): The id of the guild.
+        """
+        if guild_id not in self.queues:
+            self.queues[guild_id] = GuildQueue()
+        return self.queues[guild_id]
+
+    async def end_voice_session(self, guild_id: int):
+        """
+        Cleans up a guild's music once the bot has left voice there. Stops sharing its music, 
+        forgets its queue, and pauses Spotify if the guild's librespot is the one playing, so 
+        librespot stops filling a buffer nobody reads. Then marks its librespot session idle, so 
+        another guild can take it over. Safe to call more than once.
+
+        Parameters:
+        - guild_id (int): The id of the guild.
+        """
+        self.stop_broadcast(guild_id)
+        self.forget_queue(guild_id)
+        session = spotify_controller.librespot_pool.get(guild_id)
+        if session is None or session.is_idle:
+            return
+        if session.is_active_device():
+            try:
+                await spotify_controller.pause()
+            except spotify_controller.ControllerError as e:
+                print(f"Failed to pause Spotify after leaving voice in guild {guild_id} due to `{e}`")
+        spotify_controller.librespot_pool.release(guild_id)
+
+    def forget_queue(self, guild_id: int):
+        """
+        Throws away a guild's queue and stops it following Spotify, so nothing left in it is handed 
+        to whichever guild uses Spotify next.
+
+        Parameters:
+        - guild_id (int): The id of the guild.
+        """
+        queue = self.queues.pop(guild_id, None)
+        if queue is not None and queue.follow_task is not None:
+            queue.follow_task.cancel()
+
+    def stop_broadcast(self, guild_id: int) -> bool:
+        """
+        Stops sharing a guild's music, so the broadcast stops reading its librespot. Returns whether 
+        the guild was sharing its music.
+
+        Parameters:
+        - guild_id (int): The id of the guild whose music is shared.
+        """
+        broadcast = self.broadcasts.pop(guild_id, None)
+        if broadcast is None or not broadcast.is_running():
+            return False
+        broadcast.stop()
+        return True
+
+    def play_source(self, voice_client: discord.VoiceClient, source: discord.AudioSource):
+        """
+        Plays a source to a voice client and times how long each frame takes to send.
+
+        Parameters:
+        - voice_client (discord.VoiceClient): The voice client to play to.
+        - source (discord.AudioSource): The audio to play.
+        """
+        timer = self.send_timers.get(voice_client.guild.id)
+        if timer is None or timer.voice_client is not voice_client:
+            self.send_timers[voice_client.guild.id] = audio.SendTimer(voice_client)
+        voice_client.play(source)
+
+    def create_music_source(self, voice_client: discord.VoiceClient) -> discord.AudioSource:
+        """
+        Builds the source that plays the guild's librespot, at the voice channel's bitrate.
+
+        Parameters:
+        - voice_client (discord.VoiceClient): The voice client the source will play to.
+        """
+        return audio.create_music_source(
+            spotify_controller.get_librespot_audio(voice_client.guild.id),
+            audio.opus_bitrate(voice_client.channel),
+        )
+
+    # ======== Listeners ========
+
+    @commands.Cog.listener()
+    async def on_voice_state_update(self, member, before, after):
+        """
+        Cleans up after the bot leaves voice in a guild, however it left: `.stop`, the Stop button, 
+        being alone for too long, the voice idle timeout, or being kicked. See `end_voice_session`.
+
+        Parameters:
+        - member (discord.Member): The member whose voice state changed.
+        - before (discord.VoiceState): The member's voice state before the change.
+        - after (discord.VoiceState): The member's voice state after the change.
+        """
+        if member.id != self.bot.user.id or before.channel is None or after.channel is not None:
+            return
+        await self.end_voice_session(member.guild.id)
 
     # ======== Data Processing ========
 
@@ -350,37 +686,28 @@ class Music(commands.Cog):
         - ctx (commands.Context): The context of the command invocation.
         """
 
-        tokens = spotify_controller.get_access_token() 
+        tokens = await spotify_controller.get_access_token() 
 
         # We have an access token, but it has expired, so refresh it
-        if tokens and "access_token" in tokens and tokens["access_token"] not in ("", None) and not spotify_controller.is_valid_token(tokens["access_token"]):
+        if tokens and "access_token" in tokens and tokens["access_token"] not in ("", None) and not await spotify_controller.is_valid_token(tokens["access_token"]):
             # There is no refresh token either, so the user must relog
             if tokens["refresh_token"] in (None, ""):
                 print(f"No valid access token or refresh token found")
                 await ctx.reply("You are logged out. Try running `.login`")
                 return 
 
-            spotify_controller.refresh_token(tokens["refresh_token"])
-
-        if spotify_controller.librespot is None:
-            spotify_controller.start_librespot()
-            wait_max = 10  # seconds
-            wait = 0
-            period = 1
-            while spotify_controller.get_bot_device_id() is None and wait < wait_max:
-                time.sleep(period)
-                wait += period
+            await spotify_controller.refresh_token(tokens["refresh_token"])
 
-            if spotify_controller.get_bot_device_id() is None: 
-                print("Timeout attempting to start librespot.")
-                await ctx.reply("Timeout attempting to start librespot. You may need to log in first: `.login`")
+        if not await spotify_controller.start_librespot(ctx.guild.id):
+            if spotify_controller.librespot_pool.is_full():
+                await ctx.reply("Every librespot session is in use by other servers. Try again once one of them leaves voice")
                 return
+            print("Timeout attempting to start librespot.")
+            await ctx.reply("Timeout attempting to start librespot. You may need to log in first: `.login`")
+            return
 
         if ctx.author.voice and ctx.author.voice.channel:
-            if ctx.guild.voice_client is None:
-                await ctx.author.voice.channel.connect()
-            else:
-                await ctx.guild.voice_client.move_to(ctx.author.voice.channel)
+            await voice_connections.connect(ctx.author.voice.channel)
         else:
             await ctx.reply("You need to be in a voice channel to use this command.")
 
@@ -393,12 +720,12 @@ class Music(commands.Cog):
         - query (str): The song name or YouTube link to search for.
         """
         await self.join_voice_channel(ctx)
-        search_results = spotify_controller.search(f'"{query}"')
-        track_uri = search_results["tracks"]["items"][0]["uri"]
-        print("adding to queue", spotify_controller.add_to_queue(track_uri))
-        spotify_controller.switch_to_device()
-        if not spotify_controller.is_playing():
-            spotify_controller.play()
+        search_results = await spotify_controller.search(f'"{query}"', ["track"])
+        track = spotify_controller.Queueable(search_results["tracks"]["items"][0])
+        await self.get_queue(ctx.guild.id).add([track])
+        await spotify_controller.switch_to_device(ctx.guild.id)
+        if not await spotify_controller.is_playing():
+            await spotify_controller.play()
 
         # if self.currently_playing is not None:
         #     await self.send_now_playing(ctx, info)
@@ -432,14 +759,7 @@ class Music(commands.Cog):
         """
 
         voice_client = ctx.guild.voice_client
-        source = discord.FFmpegPCMAudio(
-            pipe=True, 
-            source=spotify_controller.librespot.stdout, 
-            before_options="-f s16le -ar 44100 -ac 2",
-            options="-f s16le -ar 48000 -ac 2",     
-        )
-
-        voice_client.play(source)
+        self.play_source(voice_client, self.create_music_source(voice_client))
         # await self.send_now_playing(ctx, info)
 
     # ======== Commands ========
@@ -447,9 +767,9 @@ class Music(commands.Cog):
     @commands.command(name="playback", help="Display a menu for controlling music playback.")
     async def playback_command(self, ctx):
         await self.join_voice_channel(ctx)
-        spotify_controller.switch_to_device()
-        if not spotify_controller.is_playing():
-            spotify_controller.play()
+        await spotify_controller.switch_to_device(ctx.guild.id)
+        if not await spotify_controller.is_playing():
+            await spotify_controller.play()
             
         voice_client = ctx.guild.voice_client 
         if not voice_client:
@@ -457,13 +777,7 @@ class Music(commands.Cog):
             return
 
         if voice_client and not voice_client.is_playing():
-            source = discord.FFmpegPCMAudio(
-                pipe=True, 
-                source=spotify_controller.librespot.stdout, 
-                before_options="-f s16le -ar 44100 -ac 2",
-                options="-f s16le -ar 48000 -ac 2",     
-            )
-            voice_client.play(source)
+            self.play_source(voice_client, self.create_music_source(voice_client))
 
         embed, view = await create_playback_embed(ctx)
         await ctx.send(embed=embed, view=view)
@@ -479,7 +793,7 @@ class Music(commands.Cog):
         **Description:**
         Removes all access tokens and requires a relog 
         """
-        success = spotify_controller.logout()
+        success = await spotify_controller.logout()
         if success:
             await ctx.reply("Successfully logged out.")
         else:
@@ -488,6 +802,8 @@ class Music(commands.Cog):
         if ctx.guild.voice_client and ctx.guild.voice_client.is_connected():
             await ctx.guild.voice_client.disconnect()
 
+        for guild_id in list(self.broadcasts):
+            self.stop_broadcast(guild_id)
         spotify_controller.stop_librespot()
 
 
@@ -556,12 +872,16 @@ name="stop", help="Stops the current song and clears the song queue."
             if voice_client.is_playing():
                 voice_client.stop()
                 await voice_client.disconnect()
+                await self.end_voice_session(ctx.guild.id)
                 return
             else:
                 await voice_client.disconnect()
             await ctx.reply("Disconnecting.")
-            spotify_controller.stop_librespot()
+            await self.end_voice_session(ctx.guild.id)
+            return
 
+        # The bot may have left some other way and still hold a librespot session
+        await self.end_voice_session(ctx.guild.id)
         await ctx.reply("I am not playing any songs right now.")
 
     @commands.command(
@@ -576,7 +896,7 @@ name="stop", help="Stops the current song and clears the song queue."
         """
         voice_client = ctx.guild.voice_client
         if voice_client is not None:
-            spotify_controller.skip("next")
+            await spotify_controller.skip("next")
             await ctx.reply("Skipping to the next song")
         else:
             await ctx.reply("I am not playing any songs right now.")
@@ -592,8 +912,8 @@ name="stop", help="Stops the current song and clears the song queue."
         Goes back to the previous song in history if available. If no history exists, informs the user.
         """
         voice_client = ctx.guild.voice_client
-        if voice_client and voice_client.is_playing() and not voice_client.is_paused():
-            spotify_controller.skip("previous")
+        if voice_client and is_music_playing(voice_client):
+            await spotify_controller.skip("previous")
             await ctx.reply("Returning to previous song")
         else:
             await ctx.reply("I am not playing any songs right now.")
@@ -607,11 +927,11 @@ name="stop", help="Stops the current song and clears the song queue."
         Pauses the current song if it's playing. If no song is playing, informs the user.
         """
         voice_client = ctx.guild.voice_client
-        if voice_client and voice_client.is_playing() and not voice_client.is_paused():
-            voice_client.pause()
+        if voice_client and is_music_playing(voice_client):
+            pause_voice(voice_client)
 
-        if spotify_controller.is_playing():
-            spotify_controller.pause()
+        if await spotify_controller.is_playing():
+            await spotify_controller.pause()
             await ctx.reply("Pausing playback")
         else:
             await ctx.reply("Already paused. You may have meant to use `.resume`")
@@ -626,12 +946,12 @@ name="stop", help="Stops the current song and clears the song queue."
         **Description:**
         Resumes the playback of the current song if it's paused. If no song is paused, informs the user.
         """
-        if not spotify_controller.is_playing():
+        if not await spotify_controller.is_playing():
             voice_client = ctx.guild.voice_client
-            if voice_client and voice_client.is_paused(): 
-                voice_client.resume()
+            if voice_client and is_music_paused(voice_client): 
+                resume_voice(voice_client)
 
-            spotify_controller.play()
+            await spotify_controller.play()
             await ctx.reply("Resuming playback")
         else:
             await ctx.reply("Already playing. You may have meant to use `.pause`")
@@ -645,10 +965,9 @@ name="stop", help="Stops the current song and clears the song queue."
         Rewinds the current song to the start and plays it again. If no song is playing, informs the user.
         """
         voice_client = ctx.guild.voice_client
-        if voice_client and voice_client.is_playing() and not voice_client.is_paused():
-            voice_client.pause()
-            self.song_queue.insert(0, self.currently_playing)
-            await self.play_next(ctx)
+        if voice_client and is_music_playing(voice_client):
+            await spotify_controller.seek(0)
+            await ctx.reply("Rewinding to the start of the song")
         else:
             await ctx.reply("I am not playing any songs right now.")
 
@@ -658,14 +977,56 @@ name="stop", help="Stops the current song and clears the song queue."
         **Usage:** `.clear`
 
         **Description:**
-        Clears the song queue if there are any songs in the queue.
+        Clears the song queue if there are any songs in the queue. Songs that have already been handed to Spotify will still play.
         """
-        if len(self.song_queue) != 0:
-            self.song_queue.clear()
+        if self.get_queue(ctx.guild.id).clear() != 0:
             await ctx.reply("Cleared the queue.")
         else:
             await ctx.reply("Nothing in the queue to clear.")
 
+    @commands.command(name="remove", help="Removes a song from the queue.")
+    async def remove_command(self, ctx, position: int):
+        """
+        **Usage:** `.remove <position>`
+
+        **Parameters:**
+        - `<position>` - The position of the song in `.queue`.
+
+        **Example:**
+        - `.remove 3` → "Removes the third song in the queue."
+
+        **Description:**
+        Removes the song at the given position from the queue.
+        """
+        try:
+            track = self.get_queue(ctx.guild.id).remove(position)
+        except IndexError as e:
+            await ctx.reply(str(e))
+            return
+        await ctx.reply(f"Removed \"{track.name}\" by {track.artists[0].name}")
+
+    @commands.command(name="move", help="Moves a song to a different position in the queue.")
+    async def move_command(self, ctx, source: int, destination: int):
+        """
+        **Usage:** `.move <from> <to>`
+
+        **Parameters:**
+        - `<from>` - The position of the song in `.queue`.
+        - `<to>` - The position to move it to.
+
+        **Example:**
+        - `.move 7 3` → "Moves the seventh song in the queue to third."
+
+        **Description:**
+        Moves a song to a different position in the queue.
+        """
+        try:
+            track = self.get_queue(ctx.guild.id).move(source, destination)
+        except IndexError as e:
+            await ctx.reply(str(e))
+            return
+        await ctx.reply(f"Moved \"{track.name}\" by {track.artists[0].name} to position {destination}")
+
     @commands.command(name="clearhistory", help="Clears the song history.")
     async def clear_history_command(self, ctx):
         """
@@ -674,8 +1035,9 @@ name="stop", help="Stops the current song and clears the song queue."
         **Description:**
         Clears the song history if there are any songs in history.
         """
-        if len(self.song_history) != 0:
-            self.song_history.clear()
+        history = self.get_queue(ctx.guild.id).history
+        if len(history) != 0:
+            history.clear()
             await ctx.reply("Cleared the history.")
         else:
             await ctx.reply("Nothing in the history to clear.")
@@ -696,11 +1058,110 @@ name="stop", help="Stops the current song and clears the song queue."
             color=discord.Color.blurple(),
         )
 
-        for index, song in enumerate(self.song_queue, start=1):
-            embed.add_field(name=f"Song {index}", value=song["title"], inline=False)
+        # Embeds hold at most 25 fields
+        for index, song in enumerate(self.get_queue(ctx.guild.id).items()[:25], start=1):
+            embed.add_field(name=f"Song {index}", value=song.discord_display_str(), inline=False)
 
         await ctx.send(embed=embed)
 
+    @commands.command(name="broadcast", help="Shares this server's music with other servers.")
+    async def broadcast_command(self, ctx):
+        """
+        **Usage:** `.broadcast`
+
+        **Example:**
+        - `.broadcast` → "Starts sharing this server's music. Run it again to stop sharing."
+
+        **Description:**
+        Shares this server's music so that other servers can listen along with `.listen`. The music is encoded once no matter how many servers listen. Run it again to stop sharing.
+        """
+        if self.stop_broadcast(ctx.guild.id):
+            await ctx.reply("Stopped sharing music.")
+            return
+
+        await self.join_voice_channel(ctx)
+        voice_client = ctx.guild.voice_client
+        if not voice_client:
+            await ctx.send("Failed to connect to voice channel.")
+            return
+        await spotify_controller.switch_to_device(ctx.guild.id)
+        if not await spotify_controller.is_playing():
+            await spotify_controller.play()
+
+        # The broadcast takes over reading librespot, and this server listens to it like any other
+        if voice_client.is_playing() or voice_client.is_paused():
+            voice_client.stop()
+        broadcast = audio.Broadcast(self.create_music_source(voice_client), audio.opus_bitrate(voice_client.channel))
+        self.broadcasts[ctx.guild.id] = broadcast
+        self.play_source(voice_client, broadcast.subscribe())
+        await ctx.reply(f"Sharing music. Other servers can listen along with `.listen {ctx.guild.id}`")
+
+    @commands.command(name="listen", help="Listens along to music shared by another server.")
+    async def listen_command(self, ctx, guild_id: int | None = None):
+        """
+        **Usage:** `.listen [guild id]`
+
+        **Parameters:**
+        - `[guild id]` - The id of the server sharing music. Optional if only one server is sharing.
+
+        **Example:**
+        - `.listen 123456789` → "Joins your voice channel and plays the music shared by server 123456789."
+
+        **Description:**
+        Joins your voice channel and plays the music another server is sharing with `.broadcast`.
+        """
+        running = {host_id: broadcast for host_id, broadcast in self.broadcasts.items() if broadcast.is_running()}
+        if guild_id is None and len(running) == 1:
+            guild_id = next(iter(running))
+        if guild_id not in running:
+            await ctx.reply("That server is not sharing music. Pick one with `.listen <guild id>`")
+            return
+
+        if not ctx.author.voice or not ctx.author.voice.channel:
+            await ctx.reply("You need to be in a voice channel to use this command.")
+            return
+        await voice_connections.connect(ctx.author.voice.channel)
+
+        voice_client = ctx.guild.voice_client
+        if voice_client.is_playing() or voice_client.is_paused():
+            voice_client.stop()
+        self.play_source(voice_client, running[guild_id].subscribe())
+        await ctx.reply(f"Listening along with {self.bot.get_guild(guild_id) or guild_id}")
+
+    @commands.command(name="audiostats", help="Shows how well audio is flowing to this server.")
+    async def audiostats_command(self, ctx):
+        """
+        **Usage:** `.audiostats`
+
+        **Description:**
+        Shows how long each audio frame takes to send, which music source is in use, and how librespot's buffer is doing.
+        """
+        lines = [f"source: {audio.MUSIC_AUDIO_SOURCE}"]
+        timer = self.send_timers.get(ctx.guild.id)
+        if timer is not None:
+            stats = timer.stats()
+            lines.append(
+                f"frames sent: {stats['frames']}  send time mean {stats['mean_ms']:.3f} ms  "
+                f"p95 {stats['p95_ms']:.3f} ms  max {stats['max_ms']:.3f} ms"
+            )
+        librespot_audio = spotify_controller.get_librespot_audio(ctx.guild.id)
+        if librespot_audio is not None:
+            lines.append(f"librespot buffer: {librespot_audio.stats()}")
+        broadcast = self.broadcasts.get(ctx.guild.id)
+        if broadcast is not None and broadcast.is_running():
+            lines.append(f"broadcast: {broadcast.stats()}")
+        voice_client = ctx.guild.voice_client
+        if voice_client is not None and isinstance(voice_client.source, audio.Mixer):
+            lines.append(f"soundboard mixer: {voice_client.source.stats()}")
+        stats = voice_connections.stats()
+        lines.append(
+            f"voice: {stats['connects']} connects, {stats['reuses']} reuses  "
+            f"connect mean {stats['connect_mean_ms']:.1f} ms max {stats['connect_max_ms']:.1f} ms  "
+            f"clip start mean {stats['play_mean_ms']:.1f} ms max {stats['play_max_ms']:.1f} ms"
+        )
+        lines.append(f"librespot sessions: {spotify_controller.librespot_pool.stats()}")
+        await ctx.reply("```\n" + "\n".join(lines) + "```")
+
     @commands.command(
         name="history", help="Displays the list of previously played songs."
     )
@@ -717,8 +1178,11 @@ name="stop", help="Stops the current song and clears the song queue."
             color=discord.Color.blurple(),
         )
 
-        for index, song in enumerate(self.song_history, start=1):
-            embed.add_field(name=f"Song {index}", value=song["title"], inline=False)
+        # Embeds hold at most 25 fields, so show the most recent songs
+        for index, song in enumerate(reversed(self.get_queue(ctx.guild.id).history), start=1):
+            if index > 25:
+                break
+            embed.add_field(name=f"Song {index}", value=song.discord_display_str(), inline=False)
 
         await ctx.send(embed=embed)
 
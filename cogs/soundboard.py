@@ -1,114 +1,680 @@
 import asyncio
-from typing import Optional
+from collections import OrderedDict
+import glob
+import itertools
+import threading
+import time
+from typing import Awaitable, Callable, Optional
 import discord
 import json
 from discord.ext import commands
 import os
+import sqlite3
 import subprocess
+import yt_dlp
+
+import audio
+from voice import voice_connections
+
+
+# The loudness every sound is normalized to
+LOUDNORM_FILTER = "loudnorm=I=-14:TP=-2:LRA=11"
+
+# Bitrate, in kbps, of the normalized Opus rendition stored for each sound
+SOUND_OPUS_BITRATE = 128
+
+# Upper bound on the memory held by decoded clips. About half an hour of Opus renditions
+CLIP_CACHE_MAX_BYTES = 32_000_000
+
+# How many of the most played sounds are loaded into the clip cache when the cog loads
+CLIP_CACHE_WARM_COUNT = 20
+
+# How many sounds can be downloaded and normalized at once across every guild
+SOUND_INGEST_WORKERS = int(os.getenv("SOUND_INGEST_WORKERS", 2))
+
+# How many sounds one guild can have waiting or in progress at once
+SOUND_INGEST_GUILD_LIMIT = int(os.getenv("SOUND_INGEST_GUILD_LIMIT", 3))
+
+# How many of one guild's sounds are worked on at once, so that one guild cannot hold every worker
+SOUND_INGEST_GUILD_CONCURRENCY = 1
+
+# Where the soundboard keeps its sounds' metadata
+SOUNDS_DB = os.getenv("SOUNDS_DB", "sounds.db")
+
+# Sounds imported from sounds.json, which predates per-guild soundboards, belong to this 
+# namespace. Every guild can play them
+SHARED_GUILD_ID = 0
+
+# Downloads larger than this are refused
+MAX_SOUND_BYTES = 100_000_000
+
+# yt-dlp options for downloading a sound. The equivalent of
+# `yt-dlp -x --format=bestaudio/best --embed-thumbnail --add-metadata`
+YTDL_OPTIONS = {
+    "format": "bestaudio/best",
+    "noplaylist": True,
+    "quiet": True,
+    "noprogress": True,
+    "writethumbnail": True,
+    "postprocessors": [
+        {"key": "FFmpegExtractAudio", "preferredcodec": "best"},
+        {"key": "FFmpegMetadata", "add_metadata": True},
+        {"key": "EmbedThumbnail"},
+    ],
+}
 
 
 class Sound:
     """
     Represents a sound that can be played in a Discord voice channel.
 
+    :param guild_id: The guild whose soundboard the sound is on, or `SHARED_GUILD_ID`.
     :param name: The name of the sound.
     :param file: The file path of the sound.
     :param url: The source URL of the sound (if applicable).
+    :param opus_file: The file path of the sound's normalized Ogg/Opus rendition, if it has one.
+    :param loudness: The integrated loudness of the original in LUFS, as measured at ingest.
+    :param plays: How many times the sound has been played.
     """
 
-    def __init__(self, name: str, file: str, url: Optional[str]) -> None:
+    def __init__(
+        self,
+        guild_id: int,
+        name: str,
+        file: str,
+        url: Optional[str],
+        opus_file: Optional[str] = None,
+        loudness: Optional[float] = None,
+        plays: int = 0,
+    ) -> None:
+        self.guild_id = guild_id
         self.name = name
         self.file = file
         self.url = url
+        self.opus_file = opus_file
+        self.loudness = loudness
+        self.plays = plays
 
-    def to_json(self) -> dict[str, Optional[str]]:
+    def create_source(self) -> discord.AudioSource:
         """
-        Converts the Sound object into a JSON-serializable dictionary.
+        Builds the audio source that plays the sound. The normalized rendition is sent as is. 
+        Sounds added before renditions existed are normalized by ffmpeg on every play.
 
-        :return: A dictionary representation of the sound.
+        :return: The audio source for the sound.
         """
 
-        return self.__dict__
+        if self.opus_file and os.path.exists(self.opus_file):
+            return audio.OggOpusAudio(self.opus_file)
+        return discord.FFmpegPCMAudio(self.file, options=f"-af {LOUDNORM_FILTER}")
 
+    @property
+    def key(self) -> tuple[int, str]:
+        return self.guild_id, self.name
 
-class Soundboard(commands.Cog):
+
+class SoundRegistry:
     """
-    A Discord bot cog that manages sound effects for voice channels.
+    Stores the soundboard's sounds in SQLite. Each guild has its own namespace of sound names, and 
+    every change is its own transaction, so concurrent ingests cannot lose each other's sounds. 
+    The first time it opens, sounds.json is imported into the `SHARED_GUILD_ID` namespace.
 
-    :param client: The Discord bot client instance.
+    :param path: The path of the database file.
     """
 
-    def __init__(self, bot):
-        self.bot = bot  # Discord bot client
-        self.sounds: dict[str, Sound] = self.init_sounds()
+    SCHEMA_VERSION = 1
 
-    def init_sounds(self) -> dict[str, Sound]:
-        """
-        Loads sound data from sounds.json.
+    def __init__(self, path: str = SOUNDS_DB) -> None:
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        # WAL lets reads carry on while a write is committing, and commits need fewer fsyncs
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.migrate()
 
-        :return: A dictionary of sound names mapped to Sound objects.
+    def migrate(self):
+        """
+        Creates the schema and imports sounds.json if the database has not been set up yet.
         """
 
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version >= self.SCHEMA_VERSION:
+            return
+
+        with self.connection:
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS sounds (
+                    guild_id INTEGER NOT NULL,
+                    name TEXT NOT NULL,
+                    file TEXT NOT NULL,
+                    url TEXT,
+                    opus_file TEXT,
+                    loudness REAL,
+                    plays INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (guild_id, name)
+                )
+                """
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS sounds_by_plays ON sounds (plays DESC)")
+            imported = self._import_json("sounds.json")
+            self.connection.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+
+        if imported:
+            os.replace("sounds.json", "sounds.json.migrated")
+            print(f"Imported {imported} sounds from sounds.json into {self.path}")
+
+    def _import_json(self, path: str) -> int:
         try:
-            with open("sounds.json", "r") as f:
+            with open(path, "r") as f:
                 sound_data = json.load(f)
         except FileNotFoundError:
-            with open("sounds.json", "w") as f:
-                f.write("{}")
-                sound_data = {}
+            return 0
         except json.JSONDecodeError:
-            print("Error in Soundboard. Could not decode sounds.json")
-            sound_data = {}
+            print(f"Error in Soundboard. Could not decode {path}")
+            return 0
+
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO sounds (guild_id, name, file, url, opus_file, loudness, plays) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    SHARED_GUILD_ID,
+                    name,
+                    sound["file"],
+                    sound["url"],
+                    sound.get("opus_file"),
+                    sound.get("loudness"),
+                    sound.get("plays", 0),
+                )
+                for name, sound in sound_data.items()
+            ],
+        )
+        return len(sound_data)
+
+    def get(self, guild_id: int, name: str) -> Optional[Sound]:
+        """
+        :return: The guild's sound called `name`, falling back to the shared sound of that name.
+        """
+
+        row = self.connection.execute(
+            "SELECT * FROM sounds WHERE guild_id IN (?, ?) AND name = ? ORDER BY guild_id = ? LIMIT 1",
+            (guild_id, SHARED_GUILD_ID, name, SHARED_GUILD_ID),
+        ).fetchone()
+        return _sound_from_row(row) if row is not None else None
+
+    def for_guild(self, guild_id: int) -> list[Sound]:
+        """
+        :return: The guild's sounds and the shared sounds, by name. The guild's own sound wins if 
+        both have one with the same name.
+        """
 
         sounds: dict[str, Sound] = {}
-        for name, sound in sound_data.items():
-            sounds[name] = Sound(name, sound["file"], sound["url"])
-        return sounds
+        rows = self.connection.execute(
+            "SELECT * FROM sounds WHERE guild_id IN (?, ?) ORDER BY guild_id = ? DESC, name",
+            (guild_id, SHARED_GUILD_ID, guild_id),
+        )
+        for row in rows:
+            sounds.setdefault(row["name"], _sound_from_row(row))
+        return sorted(sounds.values(), key=lambda sound: sound.name)
 
-    def add_sound(self, sound: Sound):
+    def most_played(self, limit: int) -> list[Sound]:
+        rows = self.connection.execute(
+            "SELECT * FROM sounds WHERE plays > 0 ORDER BY plays DESC LIMIT ?", (limit,)
+        )
+        return [_sound_from_row(row) for row in rows]
+
+    def add(self, sound: Sound) -> bool:
+        """
+        :return: False if the guild already has a sound with the same name.
         """
-        Adds a new sound to the soundboard and updates the JSON file.
 
-        :param sound: The sound object to be added.
+        try:
+            with self.connection:
+                self.connection.execute(
+                    "INSERT INTO sounds (guild_id, name, file, url, opus_file, loudness, plays) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (sound.guild_id, sound.name, sound.file, sound.url, sound.opus_file, sound.loudness, sound.plays),
+                )
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def remove(self, sound: Sound):
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM sounds WHERE guild_id = ? AND name = ?", (sound.guild_id, sound.name)
+            )
+
+    def record_play(self, sound: Sound):
+        with self.connection:
+            self.connection.execute(
+                "UPDATE sounds SET plays = plays + 1 WHERE guild_id = ? AND name = ?",
+                (sound.guild_id, sound.name),
+            )
+
+    def close(self):
+        self.connection.close()
+
+
+def _sound_from_row(row: sqlite3.Row) -> Sound:
+    return Sound(
+        row["guild_id"],
+        row["name"],
+        row["file"],
+        row["url"],
+        row["opus_file"],
+        row["loudness"],
+        row["plays"],
+    )
+
+
+class ClipCache:
+    """
+    A least recently used cache of sounds' ready to send frames, keyed by `Sound.key`. Clips are 
+    evicted, oldest use first, once their combined size goes over `max_bytes`. Safe to use from 
+    worker threads.
+
+    :param max_bytes: Upper bound on the combined size of the cached frames.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._clips: OrderedDict[tuple[int, str], tuple[tuple[bytes, ...], bool, int]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple[int, str]) -> Optional[tuple[tuple[bytes, ...], bool]]:
+        """
+        :param key: The sound's `Sound.key`.
+        :return: The sound's frames and whether they are Opus, or None if it is not cached.
         """
 
-        self.sounds[sound.name] = sound
-        with open("sounds.json", "w") as f:
-            json.dump(self.to_json(), f)
+        with self._lock:
+            clip = self._clips.get(key)
+            if clip is None:
+                self.misses += 1
+                return None
+            self._clips.move_to_end(key)
+            self.hits += 1
+            return clip[0], clip[1]
 
-    def remove_sound(self, name: str) -> Optional[Sound]:
+    def load(self, sound: Sound) -> tuple[tuple[bytes, ...], bool]:
         """
-        Removes a sound from the soundboard and deletes the file.
+        Reads every frame of a sound and caches them. Blocks until the whole sound is read, so 
+        call it from a worker thread.
 
-        :param name: The name of the sound to remove.
-        :return: The removed sound object if found, else None.
+        :param sound: The sound to load.
+        :return: The sound's frames and whether they are Opus.
         """
 
-        if name not in self.sounds:
-            return None
-        sound = self.sounds.pop(name)
+        source = sound.create_source()
+        try:
+            frames = tuple(iter(source.read, b""))
+        finally:
+            source.cleanup()
+
+        size = sum(len(frame) for frame in frames)
+        with self._lock:
+            self._remove(sound.key)
+            if size <= self.max_bytes:
+                self._clips[sound.key] = (frames, source.is_opus(), size)
+                self.size_bytes += size
+                while self.size_bytes > self.max_bytes:
+                    self._remove(next(iter(self._clips)))
+        return frames, source.is_opus()
+
+    def invalidate(self, key: tuple[int, str]):
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key: tuple[int, str]):
+        clip = self._clips.pop(key, None)
+        if clip is not None:
+            self.size_bytes -= clip[2]
+
+
+class IngestJob:
+    """
+    A sound waiting to be, or being, downloaded and added to the soundboard. Its progress is shown 
+    by editing a single message.
+
+    :param job_id: The number shown to users to tell jobs apart.
+    :param guild_id: The guild the sound was added from.
+    :param url: The url of the sound to download.
+    :param name: What to call the sound.
+    :param message: The message to show progress in.
+    """
+
+    def __init__(self, job_id: int, guild_id: int, url: str, name: str, message: discord.Message) -> None:
+        self.id = job_id
+        self.guild_id = guild_id
+        self.url = url
+        self.name = name
+        self.message = message
+        self.task: Optional[asyncio.Task] = None
+        self.cancelled = False
+        self._last_edit = 0.0
 
+    async def report(self, status: str, done: bool = False):
+        """
+        Shows the job's status in its message. Discord rate limits message edits, so updates 
+        are only shown about once a second until the job is done.
+
+        :param status: What the job is doing.
+        :param done: Whether the job has finished. Removes the cancel button.
+        """
+
+        if not done and time.monotonic() - self._last_edit < 1:
+            return
+        self._last_edit = time.monotonic()
+        view = None if done else IngestJobView(self)
         try:
-            os.remove(sound.file)
-        except FileNotFoundError:
-            print(f"Failed to remove {sound.file} in `Soundboard.remove_sound`")
+            await self.message.edit(content=f"[job {self.id}] {status}", view=view)
+        except discord.HTTPException as e:
+            print(f"Failed to show progress of ingest job {self.id} because of {e}")
 
-        with open("sounds.json", "w") as f:
-            json.dump(self.to_json(), f)
 
-        return sound
+class IngestQueue:
+    """
+    Runs sound ingest jobs on `workers` background tasks. A guild can have at most `guild_limit` 
+    jobs waiting or in progress, and at most `guild_concurrency` of them in progress, so that one 
+    busy guild does not hold up the rest.
+
+    :param run: The coroutine that carries out a job.
+    """
+
+    def __init__(
+        self,
+        run: Callable[[IngestJob], Awaitable[None]],
+        workers: int = SOUND_INGEST_WORKERS,
+        guild_limit: int = SOUND_INGEST_GUILD_LIMIT,
+        guild_concurrency: int = SOUND_INGEST_GUILD_CONCURRENCY,
+    ) -> None:
+        self.run = run
+        self.workers = workers
+        self.guild_limit = guild_limit
+        self.guild_concurrency = guild_concurrency
+        self.pending: list[IngestJob] = []
+        self.running: dict[int, IngestJob] = {}
+        self._ids = itertools.count(1)
+        self._changed = asyncio.Condition()
+        self._worker_tasks: list[asyncio.Task] = []
+
+    def start(self):
+        for _ in range(self.workers):
+            self._worker_tasks.append(asyncio.create_task(self._work()))
+
+    def stop(self):
+        for task in self._worker_tasks:
+            task.cancel()
+        self._worker_tasks.clear()
+
+    def jobs(self) -> list[IngestJob]:
+        return [*self.running.values(), *self.pending]
+
+    def has_name(self, guild_id: int, name: str) -> bool:
+        return any(job.guild_id == guild_id and job.name == name for job in self.jobs())
+
+    async def submit(self, guild_id: int, url: str, name: str, message: discord.Message) -> Optional[IngestJob]:
+        """
+        Adds a job to the back of the queue.
+
+        :return: The job, or None if the guild already has `guild_limit` jobs.
+        """
+
+        if sum(job.guild_id == guild_id for job in self.jobs()) >= self.guild_limit:
+            return None
+        job = IngestJob(next(self._ids), guild_id, url, name, message)
+        async with self._changed:
+            self.pending.append(job)
+            self._changed.notify_all()
+        return job
+
+    async def cancel(self, job_id: int) -> bool:
+        """
+        Cancels a job, whether it is waiting or in progress.
+
+        :return: False if there is no such job.
+        """
+
+        async with self._changed:
+            job = next((job for job in self.pending if job.id == job_id), None)
+            if job is not None:
+                self.pending.remove(job)
+        # Editing the message is an API call, which must not hold up other jobs waiting on the lock
+        if job is not None:
+            await job.report("Cancelled", done=True)
+            return True
+
+        job = self.running.get(job_id)
+        if job is None:
+            return False
+        job.cancelled = True
+        job.task.cancel()
+        return True
+
+    def _next_job(self) -> Optional[IngestJob]:
+        for job in self.pending:
+            running = sum(other.guild_id == job.guild_id for other in self.running.values())
+            if running < self.guild_concurrency:
+                return job
+        return None
+
+    async def _work(self):
+        while True:
+            async with self._changed:
+                job = await self._changed.wait_for(self._next_job)
+                self.pending.remove(job)
+                self.running[job.id] = job
+
+            job.task = asyncio.create_task(self.run(job))
+            try:
+                await job.task
+            except asyncio.CancelledError:
+                if not job.cancelled:
+                    job.task.cancel()
+                    raise
+                await job.report("Cancelled", done=True)
+            except Exception as e:
+                # yt-dlp and ffmpeg failures carry the useful part of the error in stderr
+                detail = getattr(e, "stderr", None) or e
+                await job.report(f"Failed to add {job.name} because of ```\n{detail}```", done=True)
+                print(f"Ingest job {job.id} for {job.url} failed because of {e}")
+            finally:
+                async with self._changed:
+                    del self.running[job.id]
+                    self._changed.notify_all()
+
+
+class IngestJobView(discord.ui.View):
+    """
+    A cancel button for an ingest job's progress message.
+
+    :param job: The job the button cancels.
+    """
+
+    def __init__(self, job: IngestJob):
+        super().__init__(timeout=None)
+        self.add_item(CancelIngestButton(job))
+
+
+class CancelIngestButton(discord.ui.Button):
+    """
+    A button that cancels an ingest job.
+
+    :param job: The job to cancel.
+    """
+
+    def __init__(self, job: IngestJob):
+        super().__init__(label="Cancel", style=discord.ButtonStyle.danger)
+        self.job = job
+
+    async def callback(self, interaction: discord.Interaction):
+        """
+        Handles the button click event and cancels the job.
+
+        :param interaction: The Discord interaction object.
+        """
+
+        soundboard = interaction.client.get_cog("Soundboard")
+        await interaction.response.defer()
+        if not await soundboard.ingest_queue.cancel(self.job.id):
+            await interaction.followup.send("That sound has already finished", ephemeral=True)
+
+
+class Soundboard(commands.Cog):
+    """
+    A Discord bot cog that manages sound effects for voice channels.
+
+    :param client: The Discord bot client instance.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot  # Discord bot client
+        self.registry = SoundRegistry()
+        self.clip_cache = ClipCache(CLIP_CACHE_MAX_BYTES)
+        self.ingest_queue = IngestQueue(self.ingest)
+        self._warm_task: Optional[asyncio.Task] = None
+
+    async def cog_load(self):
+        """
+        Starts the ingest workers and starts loading the most played sounds into the clip cache 
+        in the background.
+        """
+
+        self.ingest_queue.start()
+        most_played = self.registry.most_played(CLIP_CACHE_WARM_COUNT)
+        self._warm_task = asyncio.create_task(asyncio.to_thread(self.warm_clip_cache, most_played))
+
+    async def cog_unload(self):
+        """
+        Stops the ingest workers, cancelling any sounds in progress, and closes the registry.
+        """
+
+        self.ingest_queue.stop()
+        self.registry.close()
+
+    def warm_clip_cache(self, most_played: list[Sound]):
+        """
+        Loads sounds into the clip cache. The most played are loaded last, so they are the last 
+        to be evicted.
+
+        :param most_played: The sounds to load, most played first.
+        """
+
+        for sound in reversed(most_played):
+            try:
+                self.clip_cache.load(sound)
+            except Exception as e:
+                print(f"Failed to load {sound.name} into the clip cache because of {e}")
+        print(f"Loaded {len(most_played)} sounds into the clip cache ({self.clip_cache.size_bytes} bytes)")
+
+    async def create_source(self, sound: Sound) -> discord.AudioSource:
+        """
+        Builds an audio source for a sound from the clip cache, loading the sound first if it is 
+        not cached.
+
+        :param sound: The sound to play.
+        :return: The audio source for the sound.
+        """
+
+        clip = self.clip_cache.get(sound.key)
+        if clip is None:
+            clip = await asyncio.to_thread(self.clip_cache.load, sound)
+        return audio.FramesAudio(*clip)
+
+    def play_clip(self, voice_client: discord.VoiceClient, source: discord.AudioSource, after=None, on_start=None):
+        """
+        Plays a clip to a voice client. If nothing else is playing, the clip is played as it is, 
+        so its Opus frames are sent without re-encoding. Otherwise an `audio.Mixer` takes over the 
+        voice client's source, so music carries on under the clip and other clips overlap it. 
+        Paused music stays paused while the clip plays. Once nothing is left to mix, the mixer 
+        puts the original source back.
+
+        :param voice_client: The voice client to play to.
+        :param source: The clip to play.
+        :param after: Called when the voice client stops playing, if nothing was playing before.
+        :param on_start: Called from the voice thread when the clip starts playing.
+        """
+
+        if on_start is not None:
+            source = audio.FirstFrameHook(source, on_start)
+
+        if not voice_client.is_playing() and not voice_client.is_paused():
+            voice_client.play(source, after=after)
+            return
+
+        # Paused music is paused inside the mixer instead, so the clip can play without reading it
+        music_paused = voice_client.is_paused()
+        current = voice_client.source
+        if isinstance(current, audio.Mixer) and current.add(source):
+            if music_paused:
+                current.pause_music()
+                voice_client.resume()
+            return
 
-    def to_json(self) -> dict[str, Optional[str]]:
+        def unmix(original: discord.AudioSource, paused: bool):
+            try:
+                voice_client.source = original
+            except ValueError:
+                # The voice client stopped playing while the mixer was handing back
+                return
+            if paused:
+                voice_client.pause()
+
+        mixer = audio.Mixer(current, on_unmixed=unmix)
+        if music_paused:
+            mixer.pause_music()
+        mixer.add(source)
+        # Swapping the source resumes the voice client, which now plays the mixer
+        voice_client.source = mixer
+
+    def record_play(self, sound: Sound):
+        """
+        Counts a play of a sound, which decides which sounds are loaded into the clip cache 
+        when the cog loads.
+
+        :param sound: The sound that was played.
+        """
+
+        sound.plays += 1
+        self.registry.record_play(sound)
+
+    def add_sound(self, sound: Sound) -> bool:
+        """
+        Adds a new sound to the soundboard.
+
+        :param sound: The sound object to be added.
+        :return: False if the guild already has a sound with the same name.
+        """
+
+        return self.registry.add(sound)
+
+    def remove_sound(self, guild_id: int, name: str) -> Optional[Sound]:
         """
-        Converts the soundboard into a JSON-serializable dictionary.
+        Removes a sound from the soundboard and deletes the file.
 
-        :return: A dictionary representation of the soundboard.
+        :param guild_id: The guild to remove the sound from.
+        :param name: The name of the sound to remove.
+        :return: The removed sound object if found, else None.
         """
 
-        json = {}
-        for name, sound in self.sounds.items():
-            json[name] = sound.to_json()
-        return json
+        sound = self.registry.get(guild_id, name)
+        if sound is None:
+            return None
+        self.registry.remove(sound)
+        self.clip_cache.invalidate(sound.key)
+
+        for file in (sound.file, sound.opus_file):
+            if file is None:
+                continue
+            try:
+                os.remove(file)
+            except FileNotFoundError:
+                print(f"Failed to remove {file} in `Soundboard.remove_sound`")
+
+        return sound
 
     @commands.group(
         name="sound",
@@ -147,45 +713,53 @@ class Soundboard(commands.Cog):
         :param name: What to call the soundbyte
         """
 
-        if name in self.sounds:
+        if self.registry.get(ctx.guild.id, name) or self.ingest_queue.has_name(ctx.guild.id, name):
             await ctx.reply(f"There is already a soundbyte called {name}")
             return
 
-        try:
-            if file_size(url) > 100_000_000:  # Prevent downloading large files
-                await ctx.reply("Cannot download files over 100MB")
-                return
-        except Exception as e:
-            await ctx.reply(
-                f"Cannot verify the size of your download because of ```\n{e}```"
+        message = await ctx.reply(f"Queued {name}")
+        job = await self.ingest_queue.submit(ctx.guild.id, url, name, message)
+        if job is None:
+            await message.edit(
+                content=f"This server already has {SOUND_INGEST_GUILD_LIMIT} sounds being added. Try again once one finishes"
             )
-            print(f"Cannot verify the size of your download because of ```\n{e}```")
             return
+        await job.report(f"Queued {name}")
 
-        os.makedirs("sounds", exist_ok=True)
-        process = subprocess.run(
-            f"python3 -m yt_dlp -x --format=bestaudio/best --embed-thumbnail --add-metadata -o sounds/{name} {url}".split(
-                " "
-            ),
-            capture_output=True,
-        )
-        if process.returncode != 0:
-            await ctx.reply(
-                f"Failed to download sound because of ```\n{process.stderr.decode()}```"
-            )
-            print(
-                f"Failed to download sound because of ```\n{process.stderr.decode()}```"
-            )
-            return
+    async def ingest(self, job: IngestJob):
+        """
+        Downloads a job's sound, normalizes it and adds it to the soundboard. Runs on an ingest 
+        worker, never in a command.
+
+        :param job: The job to carry out.
+        """
+
+        async def on_progress(percent: float):
+            await job.report(f"Downloading {job.name}: {percent:.0f}%")
+
+        await job.report(f"Looking up {job.name}")
+        directory = f"sounds/{job.guild_id}"
+        os.makedirs(directory, exist_ok=True)
         try:
-            file_path = extract_file_path(process.stdout)
-        except Exception as e:
-            await ctx.reply(f"Failed to get sound file path because of ```\n{e}```")
-            print(f"Failed to get sound file path because of ```\n{e}```")
+            file_path = await download_sound(job.url, directory, job.name, on_progress)
+        except SoundTooLarge:
+            await job.report(f"Cannot download files over {MAX_SOUND_BYTES // 1_000_000}MB", done=True)
             return
 
-        self.add_sound(Sound(name, file_path, url))
-        await ctx.reply(f"Added soundbyte called {name} from {url}")
+        opus_file = f"{directory}/{job.name}.normalized.opus"
+        try:
+            await job.report(f"Normalizing {job.name}")
+            loudness = await normalize_sound_in_thread(file_path, opus_file)
+        except BaseException:
+            # Cancelled or failed, so nothing will ever refer to these files
+            _remove_files(file_path, opus_file)
+            raise
+
+        if not self.add_sound(Sound(job.guild_id, job.name, file_path, job.url, opus_file, loudness)):
+            _remove_files(file_path, opus_file)
+            await job.report(f"There is already a soundbyte called {job.name}", done=True)
+            return
+        await job.report(f"Added soundbyte called {job.name} from {job.url}", done=True)
 
     @sound.command()
     async def rm(self, ctx):
@@ -195,7 +769,7 @@ class Soundboard(commands.Cog):
         :param ctx: The context of the interaction
         """
 
-        if not self.sounds or len(self.sounds) == 0:
+        if not self.registry.for_guild(ctx.guild.id):
             await ctx.reply("There are no sounds to be removed!")
             return
         view = SoundSelect(self, True, ctx)
@@ -209,7 +783,7 @@ class Soundboard(commands.Cog):
         :param ctx: The command context.
         """
 
-        if not self.sounds or len(self.sounds) == 0:
+        if not self.registry.for_guild(ctx.guild.id):
             await ctx.reply(
                 "No sounds available! You can add some with ```\n.sound add <url> <name>```"
             )
@@ -238,11 +812,11 @@ class SoundSelect(discord.ui.View):
         self.soundboard = soundboard
         self.ctx = ctx
 
-        for sound_name in self.soundboard.sounds.keys():
+        for sound in self.soundboard.registry.for_guild(ctx.guild.id):
             if remove:
-                self.add_item(RemoveSoundButton(sound_name, soundboard, ctx))
+                self.add_item(RemoveSoundButton(sound.name, soundboard, ctx))
             else:
-                self.add_item(PlaySoundButton(sound_name, soundboard, ctx))
+                self.add_item(PlaySoundButton(sound.name, soundboard, ctx))
 
 
 class RemoveSoundButton(discord.ui.Button):
@@ -267,10 +841,14 @@ class RemoveSoundButton(discord.ui.Button):
         :param interaction: The Discord interaction object.
         """
 
-        url = self.soundboard.sounds[self.sound_name].url
-        self.soundboard.remove_sound(self.sound_name)
+        sound = self.soundboard.remove_sound(self.ctx.guild.id, self.sound_name)
+        if sound is None:
+            await interaction.response.send_message(
+                f'There is no sound called "{self.sound_name}" anymore', ephemeral=True
+            )
+            return
         await interaction.response.send_message(
-            f'Removed sound "{self.sound_name}" with url {url}'
+            f'Removed sound "{self.sound_name}" with url {sound.url}'
         )
 
 
@@ -296,90 +874,215 @@ class PlaySoundButton(discord.ui.Button):
         :param interaction: The Discord interaction object.
         """
 
-        sound = self.soundboard.sounds[self.sound_name]
-        voice_client = discord.utils.get(
-            self.ctx.bot.voice_clients, guild=self.ctx.guild
-        )
-
-        if not voice_client or not voice_client.is_connected():
-            if self.ctx.author.voice and self.ctx.author.voice.channel:
-                voice_client = await self.ctx.author.voice.channel.connect()
-            else:
-                await interaction.response.send_message(
-                    "You must be in a voice channel!", ephemeral=True
-                )
-                return
+        sound = self.soundboard.registry.get(self.ctx.guild.id, self.sound_name)
+        if sound is None:
+            await interaction.response.send_message(
+                f'There is no sound called "{self.sound_name}" anymore', ephemeral=True
+            )
+            return
+        voice_client = self.ctx.guild.voice_client
+        if self.ctx.author.voice and self.ctx.author.voice.channel:
+            # Connecting can take longer than Discord waits for a response
+            await interaction.response.defer()
+            # The connection stays warm between clips. It only moves to this channel if nothing is playing
+            voice_client = await voice_connections.connect(self.ctx.author.voice.channel, move=False)
+        elif voice_client and voice_client.is_connected():
+            await interaction.response.defer()
+            voice_connections.cancel_idle(self.ctx.guild.id)
+        else:
+            await interaction.response.send_message(
+                "You must be in a voice channel!", ephemeral=True
+            )
+            return
 
-        if voice_client.is_playing():
-            voice_client.stop()
+        connected = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        guild = self.ctx.guild
 
         def after_playing(error):
             if error:
                 print(f"Encountered error in `after_playing` for a soundbyte: {error}")
-                return
+            loop.call_soon_threadsafe(voice_connections.release, guild)
 
-            if voice_client.is_playing():
-                print("Still playing audio in soundboard.")
-                return
+        def on_start():
+            voice_connections.record_play(time.perf_counter() - connected)
 
-            coro = voice_client.disconnect()
-            fut = asyncio.run_coroutine_threadsafe(coro, self.ctx.bot.loop)
-            try:
-                fut.result()
-            except Exception as e:
-                print(f"Error in after_playing: {e}")
-
-        voice_client.play(
-            discord.FFmpegPCMAudio(
-                sound.file,
-                options="-af loudnorm=I=-14:TP=-2:LRA=11",
-            ),
-            after=after_playing,
+        self.soundboard.play_clip(
+            voice_client, await self.soundboard.create_source(sound), after=after_playing, on_start=on_start
         )
-        await interaction.response.defer()  # Some response is required to let the user know their interaction worked
+        self.soundboard.record_play(sound)
 
 
-def extract_file_path(ytdl_stdout: bytes) -> str:
+class SoundTooLarge(Exception):
     """
-    Parses the standard output of a yt-dlp call to read the file path where a file
-    was saved
+    Raised when a sound is bigger than `MAX_SOUND_BYTES`.
+    """
+
 
-    :param ytdl_stdout: The byte array passed from the stdout of a yt-dlp call
-    :return: The file path extracted from stdout
+class NormalizeCancelled(Exception):
+    """
+    Raised in `normalize_sound` when it is asked to stop.
     """
 
-    last_line = ytdl_stdout.split(b"\n").pop(-2)  # The last line that is not blank
-    path_start_index = (
-        47  # The file path should start at the 46th index of the last line
-    )
-    path_end_index = (
-        len(last_line) - 1
-    )  # The file path should end at the second to last index of the last line
-    return last_line[path_start_index:path_end_index].decode()
 
+def _download_sound(url: str, directory: str, name: str, progress_hook: Callable[[dict], None]) -> str:
+    """
+    Looks up the sound at the given url once, checks its size, then downloads the format that 
+    lookup chose. Blocks until the download is finished, so call it from a worker thread.
+
+    :param url: The url of the sound to download
+    :param directory: The directory to save the sound in
+    :param name: The file name to save the sound under, without an extension
+    :param progress_hook: Called by yt-dlp with each progress update
+    :return: The file path yt-dlp saved the sound to
+    """
+
+    options = {**YTDL_OPTIONS, "outtmpl": f"{directory}/{name}.%(ext)s", "progress_hooks": [progress_hook]}
+    with yt_dlp.YoutubeDL(options) as ytdl:
+        info = ytdl.extract_info(url, download=False)
+        size = info.get("filesize") or info.get("filesize_approx")
+        if size is not None and size > MAX_SOUND_BYTES:  # Prevent downloading large files
+            raise SoundTooLarge()
 
-def file_size(url: str) -> int:
+        # Download exactly the format that was size checked
+        ytdl.params["format"] = info["format_id"]
+        try:
+            info = ytdl.process_ie_result(info, download=True)
+        except (SoundTooLarge, yt_dlp.utils.DownloadCancelled):
+            for part in glob.glob(f"{glob.escape(directory)}/{glob.escape(name)}.*.part"):
+                os.remove(part)
+            raise
+        return info["requested_downloads"][0]["filepath"]
+
+
+async def download_sound(url: str, directory: str, name: str, on_progress: Callable[[float], Awaitable[None]]) -> str:
+    """
+    Downloads the audio at the given url in a worker thread, reporting progress as it goes. If 
+    the calling task is cancelled, the download stops at its next progress update, and anything 
+    it finished downloading first is removed.
+
+    :param url: The url of the sound to download
+    :param directory: The directory to save the sound in
+    :param name: The file name to save the sound under, without an extension
+    :param on_progress: Called with the percentage downloaded so far
+    :return: The file path the sound was saved to
     """
-    Get the size in bytes of the whole file at the given url
 
-    :param url: The url to fetch the file size of
-    :return: The size in bytes of the file at `url`
+    loop = asyncio.get_running_loop()
+    cancelled = threading.Event()
+
+    def progress_hook(progress: dict):
+        if cancelled.is_set():
+            raise yt_dlp.utils.DownloadCancelled()
+        total = progress.get("total_bytes") or progress.get("total_bytes_estimate")
+        # Some sites only give the size once the download starts
+        if total and total > MAX_SOUND_BYTES:
+            raise SoundTooLarge()
+        if progress["status"] == "downloading" and total:
+            percent = progress.get("downloaded_bytes", 0) / total * 100
+            asyncio.run_coroutine_threadsafe(on_progress(percent), loop)
+
+    download = asyncio.ensure_future(asyncio.to_thread(_download_sound, url, directory, name, progress_hook))
+    try:
+        return await asyncio.shield(download)
+    except asyncio.CancelledError:
+        cancelled.set()
+        # The thread keeps going until its next progress update, and may finish the download first
+        try:
+            _remove_files(await download)
+        except Exception:
+            pass
+        raise
+
+
+async def normalize_sound_in_thread(file_path: str, opus_file: str) -> float:
     """
+    Runs `normalize_sound` in a worker thread, since measuring loudness and encoding take a few 
+    seconds. If the calling task is cancelled, ffmpeg is killed and waited for, so it cannot 
+    write `opus_file` after the caller has cleaned up.
+
+    :param file_path: The file path of the original sound
+    :param opus_file: Where to write the normalized rendition
+    :return: The integrated loudness of the original in LUFS
+    """
+
+    cancelled = threading.Event()
+    normalizing = asyncio.ensure_future(asyncio.to_thread(normalize_sound, file_path, opus_file, cancelled))
+    try:
+        return await asyncio.shield(normalizing)
+    except asyncio.CancelledError:
+        cancelled.set()
+        await asyncio.gather(normalizing, return_exceptions=True)
+        raise
+
 
-    process = subprocess.run(
-        f'python3 -m yt_dlp --format=bestaudio/best --print "%(filesize)d" {url}'.split(
-            " "
-        ),
-        capture_output=True,
+def _remove_files(*paths: str):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def normalize_sound(file_path: str, opus_file: str, cancelled: Optional[threading.Event] = None) -> float:
+    """
+    Measures the loudness of a sound, then writes a copy normalized with `LOUDNORM_FILTER` as 
+    48 kHz stereo Ogg/Opus in 20 ms frames, which can be sent to Discord without re-encoding. The 
+    measurement is fed back into the second pass, so loudnorm can normalize linearly rather than 
+    guessing from a few seconds of lookahead
+
+    :param file_path: The file path of the original sound
+    :param opus_file: Where to write the normalized rendition
+    :param cancelled: Once set, ffmpeg is killed and `NormalizeCancelled` is raised
+    :return: The integrated loudness of the original in LUFS
+    """
+
+    process = _run_ffmpeg(
+        [
+            "ffmpeg", "-hide_banner", "-nostats", "-i", file_path,
+            "-af", f"{LOUDNORM_FILTER}:print_format=json",
+            "-f", "null", "-",
+        ],
+        cancelled,
     )
     if process.returncode != 0:
-        raise subprocess.CalledProcessError(
-            process.returncode,
-            "python3 -m yt_dlp",
-            stderr=f"Cannot read file size of sound because of ```\n{process.stdout}```",
-        )
+        raise subprocess.CalledProcessError(process.returncode, "ffmpeg", stderr=process.stderr)
+    # loudnorm prints its measurements as the last JSON object on stderr
+    stderr = process.stderr.decode(errors="replace")
+    measured = json.loads(stderr[stderr.rindex("{"):stderr.rindex("}") + 1])
+
+    process = _run_ffmpeg(
+        [
+            "ffmpeg", "-hide_banner", "-nostats", "-y", "-i", file_path, "-vn",
+            "-af", (
+                f"{LOUDNORM_FILTER}:measured_I={measured['input_i']}:measured_TP={measured['input_tp']}"
+                f":measured_LRA={measured['input_lra']}:measured_thresh={measured['input_thresh']}"
+                f":offset={measured['target_offset']}:linear=true"
+            ),
+            "-ar", "48000", "-ac", "2",
+            "-c:a", "libopus", "-b:a", f"{SOUND_OPUS_BITRATE}k", "-frame_duration", "20",
+            "-f", "ogg", opus_file,
+        ],
+        cancelled,
+    )
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, "ffmpeg", stderr=process.stderr)
 
-    return int(process.stdout.decode().strip("\" \n'"))
+    return float(measured["input_i"])
+
+
+def _run_ffmpeg(args: list[str], cancelled: Optional[threading.Event]) -> subprocess.CompletedProcess:
+    with subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as process:
+        while True:
+            try:
+                stdout, stderr = process.communicate(timeout=0.1)
+                break
+            except subprocess.TimeoutExpired:
+                if cancelled is not None and cancelled.is_set():
+                    process.kill()
+                    process.communicate()
+                    raise NormalizeCancelled()
+    return subprocess.CompletedProcess(args, process.returncode, stdout, stderr)
 
 
 async def setup(bot: commands.Bot):
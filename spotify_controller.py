@@ -1,9 +1,14 @@
 from typing import Dict
+import asyncio
+from collections import OrderedDict
+import functools
+import heapq
+import itertools
 import urllib.parse
-import requests
+import aiohttp
 import json
 import os
-import subprocess
+import threading
 import time
 
 
@@ -14,40 +19,50 @@ class ControllerError(Exception):
 
 
 class Artist:
-    def __init__(self, spotify_object: dict) -> None:
-        if spotify_object is None:
-            raise ValueError("`Artist` class requires a `SimplifiedArtistObject` from spotify")
-
-        if "type" not in spotify_object:
-            raise KeyError(f"`Artist` missing required 'type' key in spotify object `{spotify_object}`")
-
-        if spotify_object["type"] in ("show", "artist"):
-            if "name" not in spotify_object:
-                raise KeyError(f"No field `name` found in artist object: `{spotify_object}`")
-            if "external_urls" not in spotify_object:
-                raise KeyError(f"No field `external_urls` found in artist object: `{spotify_object}`")
-            if "spotify" not in spotify_object["external_urls"]:
-                raise KeyError(f"No field `spotify` found in artist object['external_urls']: `{spotify_object}`")
-
-            self.name = spotify_object["name"]
-            self.url = spotify_object["external_urls"]["spotify"]
+    """
+    The artist, show, or playlist owner credited for a track, episode, or collection. Use 
+    `Artist.parse` to build one from a Spotify object. It interns artists, so an artist that shows 
+    up in many queues and snapshots is only stored once
+    """
+    __slots__ = ("name", "url")
+    _interned: dict[tuple[str, str | None], "Artist"] = {}
 
-        elif spotify_object["type"] == "user":
-            if "display_name" not in spotify_object:
-                raise KeyError(f"No field `display_name` found in artist object: `{spotify_object}`")
-            if "external_urls" not in spotify_object:
-                raise KeyError(f"No field `external_urls` found in artist object: `{spotify_object}`")
-            if "spotify" not in spotify_object["external_urls"]:
-                raise KeyError(f"No field `spotify` found in artist object['external_urls']: `{spotify_object}`")
+    def __init__(self, name: str, url: str | None = None) -> None:
+        self.name = name
+        self.url = url
 
-            self.name = spotify_object["display_name"]
-            self.url = spotify_object["external_urls"]["spotify"]
-
-        elif spotify_object["type"] == "author":
-            if "name" not in spotify_object:
-                raise KeyError(f"No field `name` found in artist object: `{spotify_object}`")
+    @classmethod
+    def parse(cls, spotify_object: dict) -> "Artist":
+        """
+        :param spotify_object: A `SimplifiedArtistObject`, `SimplifiedShowObject`, playlist owner, 
+        or audiobook author from Spotify 
+        """
+        if spotify_object is None:
+            raise ValueError("`Artist` class requires a `SimplifiedArtistObject` from spotify")
 
-            self.name = spotify_object["name"]
+        try:
+            artist_type = spotify_object["type"]
+            if artist_type in ("show", "artist"):
+                name = spotify_object["name"]
+                url = spotify_object["external_urls"]["spotify"]
+            elif artist_type == "user":
+                name = spotify_object["display_name"]
+                url = spotify_object["external_urls"]["spotify"]
+            elif artist_type == "author":
+                name = spotify_object["name"]
+                url = None
+            else:
+                raise TypeError(f"`Artist` class received unexpected type `{artist_type}` from Spotify")
+        except KeyError as e:
+            raise KeyError(f"No field {e} found in artist object: `{spotify_object}`") from None
+
+        key = (name, url)
+        artist = cls._interned.get(key)
+        if artist is None:
+            if len(cls._interned) >= ARTIST_INTERN_MAX_ENTRIES:
+                cls._interned.clear()
+            artist = cls._interned[key] = cls(name, url)
+        return artist
 
     def discord_display_str(self) -> str:
         if self.url:
@@ -56,41 +71,75 @@ class Artist:
 
 
 class Collection:
+    """ An album or playlist. Its tracks are only fetched when asked for """
+    __slots__ = ("type", "name", "id", "artists", "total_tracks", "tracks")
+
     def __init__(self, spotify_object: dict) -> None:
         if spotify_object is None:
             raise ValueError("`Collection` class requires a spotify object")
 
-        if "type" not in spotify_object:
-            raise KeyError(f"Collection missing required field `type` in {spotify_object}`")
-        self.type = spotify_object["type"]
-
-        if "name" not in spotify_object:
-            raise KeyError(f"No field `name` found in {self.type} object `{spotify_object}`")
-        if "id" not in spotify_object:
-            raise KeyError(f"No field `id` found in {self.type} object `{spotify_object}`")
-
-        if self.type == "album":
-            if "artists" not in spotify_object:
-                raise KeyError(f"No field `artists` found in {self.type} object `{spotify_object}`")
-            self.artists = []
-            for artist in spotify_object["artists"]:
-                self.artists.append(Artist(artist))
-        
-        elif self.type == "playlist":
-            if "owner" not in spotify_object:
-                raise KeyError(f"No field `owner` found in {self.type} object `{spotify_object}`")
-            self.artists = [Artist(spotify_object["owner"]),]
+        try:
+            self.type = spotify_object["type"]
+            if self.type == "album":
+                self.artists = [Artist.parse(artist) for artist in spotify_object["artists"]]
+            elif self.type == "playlist":
+                self.artists = [Artist.parse(spotify_object["owner"]),]
+            else:
+                raise TypeError("`Collection` class received unexpected type from Spotify. Must be one of album,playlist")
+
+            self.name = spotify_object["name"]
+            self.id = spotify_object["id"]
+        except KeyError as e:
+            raise KeyError(f"No field {e} found in {spotify_object.get('type')} object `{spotify_object}`") from None
 
-        self.name = spotify_object["name"]
-        self.id = spotify_object["id"]
-        self.tracks = []
-        self.get_tracks()
+        self.total_tracks: int | None = spotify_object.get("total_tracks") or (spotify_object.get("tracks") or {}).get("total")
+        self.tracks: list[Queueable] = []
 
     def search_str(self) -> str:
         return f"{self.name} {self.artists[0].name}".lower()
 
-    def get_tracks(self):
-        response = requests.get(f"{SPOTIFY_API_PREFIX}/{self.type}s/{self.id}/tracks?limit=20", headers=get_spotify_headers())
+    async def iter_track_pages(self):
+        """
+        Yields the tracks of the album or playlist one page at a time until every page has been 
+        read. The next page is requested before the current one is yielded, so the caller can 
+        work through one page while the next is loading
+        """
+        next_page = asyncio.create_task(self._fetch_track_page(0))
+        try:
+            while next_page is not None:
+                tracks, next_offset = await next_page
+                next_page = None
+                if next_offset is not None:
+                    next_page = asyncio.create_task(self._fetch_track_page(next_offset))
+                yield tracks
+        finally:
+            if next_page is not None:
+                next_page.cancel()
+
+    async def iter_tracks(self):
+        """ Yields each track of the album or playlist in order. See `iter_track_pages` """
+        async for page in self.iter_track_pages():
+            for track in page:
+                yield track
+
+    async def get_tracks(self) -> list["Queueable"]:
+        """ Reads every track of the album or playlist into `self.tracks` """
+        self.tracks = [track async for track in self.iter_tracks()]
+        return self.tracks
+
+    async def _fetch_track_page(self, offset: int) -> tuple[list["Queueable"], int | None]:
+        """
+        :returns: Tuple. First member is the tracks on the page starting at `offset`. Second member is 
+        the offset of the page after it, or `None` if this is the last page
+        """
+        if self.type == "album": 
+            limit = ALBUM_PAGE_SIZE
+            params = {"limit": limit, "offset": offset}
+        else:
+            limit = PLAYLIST_PAGE_SIZE
+            params = {"limit": limit, "offset": offset, "fields": PLAYLIST_TRACK_FIELDS}
+
+        response = await request("GET", f"{SPOTIFY_API_PREFIX}/{self.type}s/{self.id}/tracks?{urllib.parse.urlencode(params)}", priority=BULK, headers=await get_spotify_headers())
         
         if response.status_code != 200:
             raise ControllerError(f"Failed to fetch tracks from Spotify for `Collection`. Status `{response.status_code}` and text `{response.text}`")
@@ -99,78 +148,51 @@ class Collection:
         if "items" not in body:
             raise ControllerError(f"Received unexpected response from Spotify while fetching track info for `Collection` `{self.name}`")
 
+        tracks = []
         if self.type == "album": 
             for item in body["items"]:
-                self.tracks.append(Queueable(item))
+                tracks.append(Queueable(item))
 
         elif self.type == "playlist":
             for item in body["items"]:
-                self.tracks.append(Queueable(item["track"]))
+                # Local files and tracks that are no longer available come back as `null`
+                if item.get("track") is not None:
+                    tracks.append(Queueable(item["track"]))
+
+        if body.get("next") is None:
+            return (tracks, None)
+        return (tracks, offset + limit)
 
 
 class Queueable:
+    """ A track or podcast episode that can be added to the queue """
+    __slots__ = ("type", "name", "url", "duration_ms", "uri", "image", "artists")
+
     def __init__(self, spotify_object: dict) -> None:
-        print(spotify_object)
         if spotify_object is None:
             raise ValueError("`Queueable` class requires a spotify object")
 
-        if "type" not in spotify_object:
-            raise KeyError(f"No field `type` found in track/episode object `{spotify_object}`")
-        self.type = spotify_object["type"]
-
-        if self.type == "track":
-            if "name" not in spotify_object:
-                raise KeyError(f"No field `name` found in {self.type} object `{spotify_object}`")
-            if "external_urls" not in spotify_object:
-                raise KeyError(f"No field `external_urls` found in {self.type} object `{spotify_object}`")
-            if "spotify" not in spotify_object["external_urls"]:
-                raise KeyError(f"No field `spotify` found in {self.type} object['external_urls'] `{spotify_object}`")
-            if "duration_ms" not in spotify_object:
-                raise KeyError(f"No field `duration_ms` found in {self.type} object `{spotify_object}`")
-            if "artists" not in spotify_object:
-                raise KeyError(f"No field `artists` found in {self.type} object `{spotify_object}`")
-            if "uri" not in spotify_object:
-                raise KeyError(f"No field `uri` found in {self.type} object `{spotify_object}`")
-
-            self.artists = []
-            for artist in spotify_object["artists"]:
-                self.artists.append(Artist(artist))
+        try:
+            self.type = spotify_object["type"]
+            if self.type == "track":
+                self.artists = [Artist.parse(artist) for artist in spotify_object["artists"]]
+                album = spotify_object.get("album")
+                images = album.get("images") if album else None
+                self.image = images[0]["url"] if images else None
 
-            try:
-                self.image = spotify_object["album"]["images"][0]["url"]
-            except: 
-                self.image = None
+            elif self.type == "episode":
+                self.artists = [Artist.parse(spotify_object["show"]),]
+                self.image = spotify_object["images"][0]["url"]
 
-            self.name = spotify_object["name"]
-            self.url = spotify_object["external_urls"]["spotify"]
-            self.duration_ms = spotify_object["duration_ms"]
-            self.uri = spotify_object["uri"]
+            else:
+                raise TypeError("`Queueable` class received unexpected type from Spotify. Must be one of episode,track")
 
-        elif self.type == "episode":
-            if "name" not in spotify_object:
-                raise KeyError(f"No field `name` found in {self.type} object `{spotify_object}`")
-            if "external_urls" not in spotify_object:
-                raise KeyError(f"No field `external_urls` found in {self.type} object `{spotify_object}`")
-            if "spotify" not in spotify_object["external_urls"]:
-                raise KeyError(f"No field `spotify` found in {self.type} object['external_urls'] `{spotify_object}`")
-            if "duration_ms" not in spotify_object:
-                raise KeyError(f"No field `duration_ms` found in {self.type} object `{spotify_object}`")
-            if "images" not in spotify_object:
-                raise KeyError(f"No field `images` found in {self.type} object `{spotify_object}`")
-            if "show" not in spotify_object:
-                raise KeyError(f"No field `show` found in {self.type} object `{spotify_object}`")
-            if "uri" not in spotify_object:
-                raise KeyError(f"No field `uri` found in {self.type} object `{spotify_object}`")
-
-            self.artists = [Artist(spotify_object["show"]),]
-            self.image = spotify_object["images"][0]["url"]
             self.name = spotify_object["name"]
             self.url = spotify_object["external_urls"]["spotify"]
             self.duration_ms = spotify_object["duration_ms"]
             self.uri = spotify_object["uri"]
-
-        else:
-            raise TypeError("`Queueable` class received unexpected type from Spotify. Must be one of episode,track")
+        except KeyError as e:
+            raise KeyError(f"No field {e} found in {spotify_object.get('type')} object `{spotify_object}`") from None
             
     def search_str(self) -> str:
         return f"{self.name} {self.artists[0].name}".lower()
@@ -209,12 +231,393 @@ class Queueable:
         return f"**{self.name}** [{self.humanize_duration()}] by {self.artists[0].discord_display_str()}"
 
 
-librespot = None
 SPOTIFY_API_PREFIX="https://api.spotify.com/v1"
 
+# `Artist.parse` starts over once it has interned this many artists
+ARTIST_INTERN_MAX_ENTRIES = 4096
+
+# How long to wait for a new librespot to show up as a Spotify device
+LIBRESPOT_READY_TIMEOUT = 10
+
+# How long to wait for librespot to log that it has authenticated before looking for its device anyway
+LIBRESPOT_LOG_GRACE = 2
+
+# How often, in seconds, to look for a starting librespot's device 
+LIBRESPOT_READY_POLL_INTERVAL = 0.25
+
+# How many guilds can have a librespot at once. See `LibrespotPool`
+LIBRESPOT_POOL_SIZE = int(os.getenv("LIBRESPOT_POOL_SIZE", 3))
+
+# librespot is replaced with one using a fresh access token this often, just before the old token expires
+LIBRESPOT_ROTATE_INTERVAL = 3590
+
+# How long to wait before trying again if a replacement librespot fails to start
+LIBRESPOT_ROTATE_RETRY_INTERVAL = 30
+
+# librespot's pipe backend writes 44.1 kHz signed 16 bit stereo PCM
+LIBRESPOT_BYTES_PER_SECOND = 44100 * 2 * 2
+
+# How much of librespot's audio `PCMRingBuffer` holds. When it is full librespot is made to wait, 
+# which keeps it playing in real time
+LIBRESPOT_BUFFER_SECONDS = 1
+
+# After the buffer runs dry, silence is played until this much audio has built up again, so a 
+# stuttering stream does not alternate between a few frames of audio and a few of silence
+LIBRESPOT_PREFILL_SECONDS = 0.2
+
+# How many bytes the drain thread reads from librespot's pipe at a time
+LIBRESPOT_DRAIN_CHUNK = 4096
+
+# The largest page sizes Spotify allows for album and playlist tracks
+ALBUM_PAGE_SIZE = 50
+PLAYLIST_PAGE_SIZE = 100
+
+# Only the parts of a playlist item that `Queueable` reads
+PLAYLIST_TRACK_FIELDS = "next,items(track(type,uri,name,duration_ms,external_urls,artists(type,name,display_name,external_urls),album(images),images,show(type,name,external_urls)))"
+
+# Every call to Spotify or the auth server is abandoned after this long so that a slow round 
+# trip can never hold up the rest of the bot
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=10, connect=5)
+
+# Upper bound on the number of HTTP requests in flight at once across all guilds 
+MAX_CONCURRENT_REQUESTS = 8
+
+# The cached access token is refreshed this many seconds before it actually expires
+TOKEN_REFRESH_MARGIN = 60
+
+# How long to trust a cached access token if the auth server does not say when it expires 
+DEFAULT_TOKEN_LIFETIME = 300
+
+# How many seconds a `PlaybackSnapshot` can be reused before the queue is fetched again
+SNAPSHOT_TTL = 2
 
-def is_valid_token(token: str) -> bool:
-    response = requests.get(f"{SPOTIFY_API_PREFIX}/tracks/2TpxZ7JUBn3uw46aR7qd6V", headers={
+# Sustained rate and burst size of the token bucket every Spotify Web API request goes through
+SPOTIFY_REQUESTS_PER_SECOND = 10
+SPOTIFY_REQUEST_BURST = 20
+
+# How many times a request that Spotify answers with 429 is retried before giving up
+MAX_RATE_LIMIT_RETRIES = 3
+
+# The longest Retry-After, in seconds, that is waited out. Throttling holds up every request from the bot, 
+# interactive ones included, so a longer one fails the request instead
+MAX_RETRY_AFTER = 10
+
+# Request priorities for `RequestScheduler`. Lower values are sent first
+INTERACTIVE = 0
+BULK = 1
+
+# Limits for the cache of search responses. Results older than the TTL are fetched again 
+SEARCH_CACHE_TTL = 600
+SEARCH_CACHE_MAX_ENTRIES = 256
+SEARCH_CACHE_MAX_BYTES = 8_000_000
+
+# Limits for the cache of episode objects 
+EPISODE_CACHE_TTL = 3600
+EPISODE_CACHE_MAX_ENTRIES = 512
+EPISODE_CACHE_MAX_BYTES = 8_000_000
+
+# The most ids Spotify accepts in one request to `/episodes`
+EPISODE_BATCH_SIZE = 50
+
+_session: aiohttp.ClientSession | None = None
+
+
+class Response:
+    """ 
+    The status, body, and headers of an HTTP response. The body is read in full before the 
+    connection is handed back to the pool, so it is safe to keep these around 
+    """
+    def __init__(self, status_code: int, text: str, headers: dict) -> None:
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers
+
+
+def get_session() -> aiohttp.ClientSession:
+    """
+    Returns the `aiohttp` session shared by every request the controller makes, creating it on 
+    first use. Connections are pooled and kept alive between calls, and the connector limit 
+    bounds how many requests can be in flight at once
+
+    Must be called from within a running event loop
+    """
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=MAX_CONCURRENT_REQUESTS, keepalive_timeout=60),
+            timeout=REQUEST_TIMEOUT,
+        )
+    return _session
+
+
+async def close_session():
+    """ Closes the shared `aiohttp` session. The next request will open a new one """
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+class RequestScheduler:
+    """
+    Decides when each Spotify Web API request may be sent. Requests wait for a token from a 
+    token bucket, and everything waits while Spotify has asked us to back off with `Retry-After`. 
+    Waiting requests are released in priority order, so interactive commands like play, pause, 
+    and skip go ahead of bulk work like queueing a playlist
+
+    :ivar dispatched: The number of requests released so far 
+    :ivar throttled: The number of 429 responses received from Spotify
+    :ivar throttled_seconds: The total time spent backing off because of `Retry-After`
+    """
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.dispatched = 0
+        self.throttled = 0
+        self.throttled_seconds = 0.0
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._order = itertools.count()
+        self._dispatch_task: asyncio.Task | None = None
+
+    @property
+    def queue_depth(self) -> int:
+        """ The number of requests waiting to be sent """
+        return sum(1 for _, _, future in self._waiters if not future.done())
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "queue_depth": self.queue_depth,
+            "dispatched": self.dispatched,
+            "throttled": self.throttled,
+            "throttled_seconds": self.throttled_seconds,
+        }
+
+    async def acquire(self, priority: int = INTERACTIVE):
+        """ Waits until a request with the given priority may be sent """
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._order), future))
+        if self._dispatch_task is None:
+            self._dispatch_task = asyncio.create_task(self._dispatch())
+        await future
+
+    def throttle(self, seconds: float):
+        """ Holds back every request for `seconds`, as asked for by a `Retry-After` header """
+        self.throttled += 1
+        self.throttled_seconds += seconds
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def _dispatch(self):
+        try:
+            while self._waiters:
+                # Skip requests whose caller gave up while waiting
+                if self._waiters[0][2].done():
+                    heapq.heappop(self._waiters)
+                    continue
+
+                now = time.monotonic()
+                self._refill(now)
+                wait = self.blocked_until - now
+                if wait <= 0 and self.tokens < 1:
+                    wait = (1 - self.tokens) / self.rate
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    continue
+
+                self.tokens -= 1
+                self.dispatched += 1
+                heapq.heappop(self._waiters)[2].set_result(None)
+        finally:
+            self._dispatch_task = None
+
+
+scheduler = RequestScheduler(SPOTIFY_REQUESTS_PER_SECOND, SPOTIFY_REQUEST_BURST)
+
+
+async def request(method: str, url: str, priority: int = INTERACTIVE, **kwargs) -> Response:
+    """
+    Sends a request over the shared session. Takes the same keyword arguments as 
+    `aiohttp.ClientSession.request`. Requests to the Spotify Web API are sent through `scheduler`, 
+    and retried up to `MAX_RATE_LIMIT_RETRIES` times if Spotify answers 429 
+
+    :param priority: `INTERACTIVE` or `BULK`. Only used for Spotify Web API requests
+    :raises ControllerError: If the request times out or the connection fails, or if Spotify asks 
+    for a back-off longer than `MAX_RETRY_AFTER` seconds
+    """
+    is_spotify = url.startswith(SPOTIFY_API_PREFIX)
+    retries = 0
+    while True:
+        if is_spotify:
+            await scheduler.acquire(priority)
+
+        try:
+            async with get_session().request(method, url, **kwargs) as response:
+                result = Response(response.status, await response.text(), dict(response.headers))
+        except asyncio.TimeoutError:
+            raise ControllerError(f"{method} {url.split('?')[0]} timed out after {REQUEST_TIMEOUT.total} seconds")
+        except aiohttp.ClientError as e:
+            raise ControllerError(f"{method} {url.split('?')[0]} failed due to `{e}`")
+
+        if not is_spotify or result.status_code != 429 or retries >= MAX_RATE_LIMIT_RETRIES:
+            break
+        retries += 1
+        retry_after = float(result.headers.get("Retry-After", 1))
+        if retry_after > MAX_RETRY_AFTER:
+            raise ControllerError(f"{method} {url.split('?')[0]} was rate limited by Spotify for {retry_after:.0f} seconds")
+        print(f"{method} {url.split('?')[0]} was rate limited. Retrying in {retry_after} seconds")
+        scheduler.throttle(retry_after)
+
+    # Spotify rejected the cached token, so make sure the next call fetches a fresh one
+    if result.status_code == 401 and is_spotify:
+        token_cache.invalidate()
+    # Player endpoints answer 404 when the device is gone or no longer active
+    if result.status_code == 404 and url.startswith(f"{SPOTIFY_API_PREFIX}/me/player"):
+        device_registry.invalidate()
+    return result
+
+
+class TokenCache:
+    """
+    Keeps the access token from the auth server in memory until shortly before it expires, so 
+    that Spotify calls do not each need a round trip to the auth server. Concurrent callers that 
+    find the cache stale all wait on the same refresh 
+
+    :ivar hits: The number of times a token was served from memory 
+    :ivar refreshes: The number of times a token was fetched from the auth server
+    """
+    def __init__(self) -> None:
+        self.tokens: Dict[str, str] | None = None
+        self.expires_at = 0.0
+        self.hits = 0
+        self.refreshes = 0
+        self._refresh_task: asyncio.Task | None = None
+
+    def is_fresh(self) -> bool:
+        return self.tokens is not None and time.monotonic() < self.expires_at - TOKEN_REFRESH_MARGIN
+
+    def invalidate(self):
+        """ Forgets the cached token. The next call to `get` will fetch a new one """
+        self.tokens = None
+        self.expires_at = 0.0
+
+    async def get(self) -> Dict[str, str] | None:
+        if self.is_fresh():
+            self.hits += 1
+            return self.tokens
+
+        if self._refresh_task is None:
+            self._refresh_task = asyncio.create_task(self._refresh())
+        # Shielded so that one caller being cancelled does not cancel the refresh for everyone else
+        return await asyncio.shield(self._refresh_task)
+
+    async def _refresh(self) -> Dict[str, str] | None:
+        try:
+            tokens = await _fetch_access_token()
+            self.refreshes += 1
+            # The auth server answers `expires_in: 0` once its token has expired, so only a missing 
+            # lifetime falls back to the default
+            expires_in = tokens.get("expires_in") if tokens else None
+            if expires_in is not None and float(expires_in) <= TOKEN_REFRESH_MARGIN:
+                refreshed = await refresh_token(tokens.get("refresh_token") or os.getenv("SPOTIFY_REFRESH_TOKEN"))
+                if refreshed is None:
+                    self.invalidate()
+                    return tokens
+                tokens = {**tokens, **refreshed}
+                expires_in = tokens.get("expires_in")
+
+            if tokens and tokens.get("access_token") and (expires_in is None or float(expires_in) > TOKEN_REFRESH_MARGIN):
+                self.tokens = tokens
+                self.expires_at = time.monotonic() + float(DEFAULT_TOKEN_LIFETIME if expires_in is None else expires_in)
+            else:
+                self.invalidate()
+            return tokens
+        finally:
+            self._refresh_task = None
+
+
+token_cache = TokenCache()
+
+
+class DeviceRegistry:
+    """
+    Remembers the Spotify device id of the librespot the bot is playing through and whether it is 
+    the active device, so that player commands do not each need to list devices first. The registry 
+    is only cleared when that librespot is stopped or Spotify reports that the device cannot be 
+    found. `switch_to_device` points it at another guild's librespot
+
+    :ivar name: The name of the device to look for. Defaults to the `BOT_NAME` environment variable
+    """
+    def __init__(self) -> None:
+        self.name: str | None = None
+        self.device_id: str | None = None
+        self.is_active = False
+        self._lookup_task: asyncio.Task | None = None
+
+    def invalidate(self):
+        self.device_id = None
+        self.is_active = False
+
+    def set_device(self, name: str, device_id: str, is_active: bool):
+        """ Records a device found some other way, such as by a librespot that was just started """
+        self.name = name
+        self.device_id = device_id
+        self.is_active = is_active
+
+    async def get_device_id(self) -> str | None:
+        """
+        :returns: The id of the bot's device, or `None` if librespot has not registered with Spotify yet
+        """
+        if self.device_id is not None:
+            return self.device_id
+
+        if self._lookup_task is None:
+            self._lookup_task = asyncio.create_task(self._lookup())
+        return await asyncio.shield(self._lookup_task)
+
+    async def _lookup(self) -> str | None:
+        try:
+            device = await find_device(self.name or os.getenv("BOT_NAME"))
+            if device is None:
+                return None
+            self.device_id = device["id"]
+            self.is_active = device["is_active"]
+            return self.device_id
+        finally:
+            self._lookup_task = None
+
+
+async def find_device(name: str) -> dict | None:
+    """
+    Lists the account's devices and picks out the one called `name`. Always asks Spotify, so 
+    prefer `get_bot_device_id` for the bot's own device 
+
+    :returns: The device object from Spotify, or `None` if there is no device called `name`
+    """
+    response = await request("GET", f"{SPOTIFY_API_PREFIX}/me/player/devices", headers=await get_spotify_headers())
+    if 300 > response.status_code >= 200:
+        body = json.loads(response.text)
+        for device in body["devices"]: 
+            if device["name"] == name: 
+                print(f"found device {device['id']}")
+                return device
+        print(f"find_device failed to find a device called {name}")
+    else:
+        print(f"find_device failed with response {response.status_code} and text {response.text}")
+    return None
+
+
+device_registry = DeviceRegistry()
+
+
+async def is_valid_token(token: str) -> bool:
+    response = await request("GET", f"{SPOTIFY_API_PREFIX}/tracks/2TpxZ7JUBn3uw46aR7qd6V", headers={
         "Authorization": f"Bearer {token}"
     })
     if 300 > response.status_code >= 200:
@@ -224,7 +627,7 @@ def is_valid_token(token: str) -> bool:
     raise ValueError(f"is_valid_token received unexpected response from Spotify: code {response.status_code} and text {response.text}")
 
 
-def logout() -> bool: 
+async def logout() -> bool: 
     """
     "Logs out" the user by removing all references to access tokens or refresh tokens both locally 
     as well as on the auth server
@@ -240,7 +643,8 @@ def logout() -> bool:
     if os.getenv("SPOTIFY_REFRESH_TOKEN"):
         del os.environ["SPOTIFY_REFRESH_TOKEN"]
 
-    response = requests.delete(f"{os.getenv('AUTH_SERVER')}/access-token/{os.getenv('AUTH_SERVER_SECURITY')}")
+    token_cache.invalidate()
+    response = await request("DELETE", f"{os.getenv('AUTH_SERVER')}/access-token/{os.getenv('AUTH_SERVER_SECURITY')}")
     if 300 > response.status_code >= 200:
         print("Successfully logged out")
         return True 
@@ -249,112 +653,253 @@ def logout() -> bool:
     return False 
 
 
-def refresh_token(refresh_token: str) -> Dict[str, str] | None: 
-    response = requests.post(f"{os.getenv('AUTH_SERVER')}/refresh-token?state={os.getenv('AUTH_SERVER_SECURITY')}&refresh_token={refresh_token}")
+async def refresh_token(refresh_token: str) -> Dict[str, str] | None: 
+    response = await request("POST", f"{os.getenv('AUTH_SERVER')}/refresh-token?state={os.getenv('AUTH_SERVER_SECURITY')}&refresh_token={refresh_token}")
     if 300 > response.status_code >= 200:
         body = json.loads(response.text)
+        token_cache.invalidate()
         return body
 
     print(f"refresh_token failed with code {response.status_code} and text {response.text}")
     return None
 
 
-def get_spotify_headers(): 
+async def get_spotify_headers(): 
     return {
-        "Authorization": f"Bearer {get_access_token()['access_token']}",
+        "Authorization": f"Bearer {(await get_access_token())['access_token']}",
     }
 
 
-def get_access_token() -> Dict[str, str] | None:
-    response = requests.get(f"{os.getenv('AUTH_SERVER')}/access-token/{os.getenv('AUTH_SERVER_SECURITY')}")
+async def get_access_token() -> Dict[str, str] | None:
+    """
+    Returns the current tokens, served from memory unless they are close to expiring. See `TokenCache`
+    """
+    return await token_cache.get()
+
+
+async def _fetch_access_token() -> Dict[str, str] | None:
+    response = await request("GET", f"{os.getenv('AUTH_SERVER')}/access-token/{os.getenv('AUTH_SERVER_SECURITY')}")
     if 300 > response.status_code >= 200:
         return json.loads(response.text)
-    return refresh_token(os.getenv("SPOTIFY_REFRESH_TOKEN"))
+    return await refresh_token(os.getenv("SPOTIFY_REFRESH_TOKEN"))
 
 
-def is_playing():
-    response = requests.get(f"{SPOTIFY_API_PREFIX}/me/player", headers=get_spotify_headers())
+async def is_playing():
+    response = await request("GET", f"{SPOTIFY_API_PREFIX}/me/player", headers=await get_spotify_headers())
     if 300 > response.status_code >= 200: 
+        # Spotify answers with no body when nothing is playing on any device
+        if not response.text:
+            device_registry.is_active = False
+            return False
         body = json.loads(response.text)
+        device = body.get("device") or {}
+        device_registry.is_active = device_registry.device_id is not None and device.get("id") == device_registry.device_id
         return body["is_playing"]
     
     print(f"is_playing failed with status {response.status_code} and text {response.text}")
 
 
-def get_now_playing() -> Queueable: 
-    response = requests.get(f"{SPOTIFY_API_PREFIX}/me/player/queue", headers=get_spotify_headers())
-    if response.status_code == 200:
-        body = json.loads(response.text)
-        try: 
-            return Queueable(body["currently_playing"])
-        except Exception as e: 
-            raise ControllerError(f"get_now_playing failed to create track info due to `{e}`")
+class PlaybackSnapshot:
+    """
+    The currently playing item and the queue behind it, parsed from a single response from 
+    `/me/player/queue`
+
+    :ivar now_playing: What is playing right now, or `None` if nothing is 
+    :ivar queue: Everything queued after `now_playing`, in order
+    :ivar fetched_at: `time.monotonic()` at the moment the snapshot was taken
+    """
+    def __init__(self, spotify_object: dict) -> None:
+        self.now_playing: Queueable | None = None
+        if spotify_object.get("currently_playing") is not None:
+            try: 
+                self.now_playing = Queueable(spotify_object["currently_playing"])
+            except Exception as e: 
+                raise ControllerError(f"PlaybackSnapshot failed to create track info due to `{e}`")
 
-    raise ControllerError(f"get_now_playing failed with status {response.status_code} and text `{response.text}`")
+        self.queue: list[Queueable] = []
+        for track in spotify_object.get("queue", []):
+            try: 
+                self.queue.append(Queueable(track))
+            except Exception as e:
+                raise ControllerError(f"PlaybackSnapshot failed to create track info due to `{e}`")
 
+        self.fetched_at = time.monotonic()
 
-def get_queue(): 
-    response = requests.get(f"{SPOTIFY_API_PREFIX}/me/player/queue", headers=get_spotify_headers())
-    if response.status_code != 200:
-        raise ControllerError(f"get_queue failed with status {response.status_code} and text `{response.text}`")
+    def age(self) -> float:
+        return time.monotonic() - self.fetched_at
 
-    body = json.loads(response.text)
-    queue = []
-    for track in body["queue"]:
-        try: 
-            queue.append(Queueable(track))
-        except Exception as e:
-            raise ControllerError(f"get_queue failed to create track info due to `{e}`")
 
-    return queue
+_snapshot: PlaybackSnapshot | None = None
+_snapshot_task: asyncio.Task | None = None
 
 
-def clear_queue():
-    queue = get_queue()
-    headers = get_spotify_headers()
+def invalidate_playback_snapshot():
+    """ Forces the next call to `get_playback_snapshot` to fetch the queue from Spotify """
+    global _snapshot
+    _snapshot = None
+
+
+async def get_playback_snapshot(max_age: float = SNAPSHOT_TTL) -> PlaybackSnapshot:
+    """
+    Returns the current playback state. A snapshot younger than `max_age` seconds is reused, and 
+    concurrent callers share one request when a new snapshot is needed 
+
+    :param max_age: The oldest snapshot, in seconds, the caller is willing to accept
+    """
+    global _snapshot_task
+    if _snapshot is not None and _snapshot.age() < max_age:
+        return _snapshot
+
+    if _snapshot_task is None:
+        _snapshot_task = asyncio.create_task(_fetch_playback_snapshot())
+    return await asyncio.shield(_snapshot_task)
+
+
+async def _fetch_playback_snapshot() -> PlaybackSnapshot:
+    global _snapshot, _snapshot_task
+    try:
+        response = await request("GET", f"{SPOTIFY_API_PREFIX}/me/player/queue", headers=await get_spotify_headers())
+        if response.status_code != 200:
+            raise ControllerError(f"get_playback_snapshot failed with status {response.status_code} and text `{response.text}`")
+
+        _snapshot = PlaybackSnapshot(json.loads(response.text))
+        return _snapshot
+    finally:
+        _snapshot_task = None
+
+
+async def get_now_playing() -> Queueable: 
+    now_playing = (await get_playback_snapshot()).now_playing
+    if now_playing is None:
+        raise ControllerError("get_now_playing failed because nothing is playing")
+    return now_playing
+
+
+async def get_queue() -> list[Queueable]: 
+    return (await get_playback_snapshot()).queue
+
+
+async def clear_queue():
+    queue = await get_queue()
+    headers = await get_spotify_headers()
     for i in range(len(queue)):
-        skip("next", headers=headers)
+        await skip("next", headers=headers, priority=BULK)
 
     try:
-        skip("next", headers=headers)
+        await skip("next", headers=headers, priority=BULK)
     except:
         pass
 
 
-def play():
-    response = requests.put(f"{SPOTIFY_API_PREFIX}/me/player/play?device_id={get_bot_device_id()}", headers=get_spotify_headers())
+async def play():
+    response = await request("PUT", f"{SPOTIFY_API_PREFIX}/me/player/play?device_id={await get_bot_device_id()}", headers=await get_spotify_headers())
     if 300 > response.status_code >= 200:
         print("Resuming playback")
     else:
         print(f"Failed to resume playback with status {response.status_code} and text {response.text}")
 
 
-def pause():
-    response = requests.put(f"{SPOTIFY_API_PREFIX}/me/player/pause?device_id={get_bot_device_id()}", headers=get_spotify_headers())
+async def pause():
+    response = await request("PUT", f"{SPOTIFY_API_PREFIX}/me/player/pause?device_id={await get_bot_device_id()}", headers=await get_spotify_headers())
     if 300 > response.status_code >= 200:
         print("Pausing playback")
     else:
         print(f"Failed to pause playback with status {response.status_code} and text {response.text}")
 
 
-def skip(dir: str, headers=None):
+async def seek(position_ms: int = 0):
+    """
+    :param position_ms: Where in the current item to play from, in milliseconds
+    """
+    response = await request("PUT", f"{SPOTIFY_API_PREFIX}/me/player/seek?position_ms={position_ms}&device_id={await get_bot_device_id()}", headers=await get_spotify_headers())
+    invalidate_playback_snapshot()
+    if 300 > response.status_code >= 200:
+        print(f"Seeking to {position_ms} ms")
+    else:
+        raise ControllerError(f"Failed to seek with status {response.status_code} and text {response.text}")
+
+
+async def skip(dir: str, headers=None, priority: int = INTERACTIVE):
     """
     :param dir: Either 'next' or 'previous'
+    :param priority: `INTERACTIVE` or `BULK`. See `RequestScheduler`
     """
     if dir not in ("next", "previous"):
         raise ValueError("dir must either be 'next' or 'previous'")
 
     if headers is None:
-        headers = get_spotify_headers()
+        headers = await get_spotify_headers()
         
-    response = requests.post(f"{SPOTIFY_API_PREFIX}/me/player/{dir}?device_id={get_bot_device_id()}", headers=headers)
+    response = await request("POST", f"{SPOTIFY_API_PREFIX}/me/player/{dir}?device_id={await get_bot_device_id()}", priority=priority, headers=headers)
+    invalidate_playback_snapshot()
     if 300 > response.status_code >= 200:
         print(f"Skipping to {dir}")
     else:
         raise ControllerError(f"Failed to skip with status {response.status_code} and text {response.text}")
 
 
-def search(query: str, search_type: list[str], limit: int = 1):
+class ResponseCache:
+    """
+    A least recently used cache of raw response bodies that expire after `ttl` seconds. Entries 
+    are evicted, oldest use first, once there are more than `max_entries` of them or their 
+    combined size goes over `max_bytes`
+
+    :ivar hits: The number of lookups answered from the cache 
+    :ivar misses: The number of lookups that had to go to Spotify
+    """
+    def __init__(self, ttl: float, max_entries: int, max_bytes: int) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[object, tuple[float, str, int]] = OrderedDict()
+
+    def get(self, key) -> str | None:
+        entry = self._entries.get(key)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, text: str):
+        if key in self._entries:
+            self._remove(key)
+        # Responses are JSON, which can hold non-ASCII text, so count encoded bytes rather than characters
+        size = len(text.encode())
+        if size > self.max_bytes:
+            return
+
+        self._entries[key] = (time.monotonic(), text, size)
+        self.size_bytes += size
+        while len(self._entries) > self.max_entries or self.size_bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        self._entries.clear()
+        self.size_bytes = 0
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self.size_bytes -= size
+
+
+search_cache = ResponseCache(SEARCH_CACHE_TTL, SEARCH_CACHE_MAX_ENTRIES, SEARCH_CACHE_MAX_BYTES)
+episode_cache = ResponseCache(EPISODE_CACHE_TTL, EPISODE_CACHE_MAX_ENTRIES, EPISODE_CACHE_MAX_BYTES)
+
+
+def search_cache_key(query: str, search_type: list[str], limit: int) -> tuple:
+    """ Searches that differ only in case, whitespace, or the order of `search_type` share a key """
+    return (" ".join(query.lower().split()), tuple(sorted(set(search_type))), limit)
+
+
+async def search(query: str, search_type: list[str], limit: int = 1):
     if len(search_type) == 0:
         raise ControllerError("spotify_controller.search expects at least one value in `search_type`")
 
@@ -362,33 +907,72 @@ def search(query: str, search_type: list[str], limit: int = 1):
         if t not in ("album", "playlist", "track", "episode"):
             raise ValueError(f"`search_type` of spotify_controller.search must contain only 'album', 'playlist', 'track', 'episode'")
 
+    cache_key = search_cache_key(query, search_type, limit)
+    cached = search_cache.get(cache_key)
+    if cached is not None:
+        return json.loads(cached)
+
     type_str = ",".join(search_type)
 
     encoded_query = urllib.parse.quote_plus(query)
-    response = requests.get(f"{SPOTIFY_API_PREFIX}/search?q={encoded_query}&type={type_str}&limit={limit}", headers=get_spotify_headers())
+    response = await request("GET", f"{SPOTIFY_API_PREFIX}/search?q={encoded_query}&type={type_str}&limit={limit}", headers=await get_spotify_headers())
 
     if response.status_code != 200:
         raise ControllerError(f"spotify_controller.search failed with status `{response.status_code}` and text `{response.text}`")
 
+    search_cache.put(cache_key, response.text)
     return json.loads(response.text)
 
 
-def get_episode(id: str): 
-    response = requests.get(f"{SPOTIFY_API_PREFIX}/episodes/{id}", headers=get_spotify_headers())
-    if response.status_code == 200:
-        return json.loads(response.text)
-    elif response.status_code == 401:
-        raise ControllerError("get_episode failed. Looks like you are logged out")
-    else:
-        raise ControllerError(f"get_episode failed with status `{response.status_code}` and text `{response.text}`")
+async def get_episode(id: str): 
+    episodes = await get_episodes([id])
+    if id not in episodes:
+        raise ControllerError(f"get_episode failed to find an episode with id `{id}`")
+    return episodes[id]
+
+
+async def get_episodes(ids: list[str]) -> dict[str, dict]: 
+    """
+    Looks up several episodes at once. Episodes seen recently are served from `episode_cache`, 
+    and the rest are fetched `EPISODE_BATCH_SIZE` at a time from `/episodes`
+
+    :param ids: The Spotify ids of the episodes 
+    :returns: The episode objects found, keyed by id. Ids Spotify does not know are left out
+    """
+    episodes = {}
+    missing = []
+    for id in dict.fromkeys(ids):
+        cached = episode_cache.get(id)
+        if cached is not None:
+            episodes[id] = json.loads(cached)
+        else:
+            missing.append(id)
+
+    for start in range(0, len(missing), EPISODE_BATCH_SIZE):
+        batch = missing[start:start + EPISODE_BATCH_SIZE]
+        response = await request("GET", f"{SPOTIFY_API_PREFIX}/episodes?ids={','.join(batch)}", headers=await get_spotify_headers())
+        if response.status_code == 401:
+            raise ControllerError("get_episodes failed. Looks like you are logged out")
+        elif response.status_code != 200:
+            raise ControllerError(f"get_episodes failed with status `{response.status_code}` and text `{response.text}`")
+
+        for episode in json.loads(response.text)["episodes"]:
+            # Unknown ids come back as `null` in the position they were asked for
+            if episode is None:
+                continue
+            episode_cache.put(episode["id"], json.dumps(episode))
+            episodes[episode["id"]] = episode
+
+    return episodes
 
 
-def add_to_queue(uri: str, headers=None): 
+async def add_to_queue(uri: str, headers=None): 
     if headers is None:
-        headers = get_spotify_headers()
+        headers = await get_spotify_headers()
 
     encoded_uri = urllib.parse.quote(uri)
-    response = requests.post(f"{SPOTIFY_API_PREFIX}/me/player/queue?uri={encoded_uri}&device_id={get_bot_device_id()}", headers=headers)
+    response = await request("POST", f"{SPOTIFY_API_PREFIX}/me/player/queue?uri={encoded_uri}&device_id={await get_bot_device_id()}", headers=headers)
+    invalidate_playback_snapshot()
     if 300 > response.status_code >= 200:
         return response
    
@@ -398,34 +982,56 @@ def add_to_queue(uri: str, headers=None):
     raise ControllerError(f"add_to_queue failed with response `{response.status_code}` and text `{response.text}`")
 
 
-def get_bot_device_id(): 
-    response = requests.get(f"{SPOTIFY_API_PREFIX}/me/player/devices", headers=get_spotify_headers())
-    if 300 > response.status_code >= 200:
-        body = json.loads(response.text)
-        for device in body["devices"]: 
-            if device["name"] == os.getenv("BOT_NAME"): 
-                print(f"found device {device['id']}")
-                return device["id"]
-        print("get_bot_device_id failed to find a device")
-    else:
-        print(f"get_bot_device_id failed with response {response.status_code} and text {response.text}")
+async def add_many_to_queue(uris: list[str], on_progress=None) -> int:
+    """
+    Adds every item in `uris` to the queue in the given order. Spotify queues items in the order 
+    its requests arrive, so each request is sent as soon as the one before it is answered, reusing 
+    the same pooled connection, token, and device id. Requests are sent with `BULK` priority so 
+    that interactive commands are not held up behind a long playlist
+
+    :param uris: The Spotify uris to queue 
+    :param on_progress: Optional coroutine function, awaited as `on_progress(queued, total)` after 
+    each item is queued
+    :returns: The number of items queued
+    :raises ControllerError: If any item fails to queue. Items before it stay queued
+    """
+    headers = await get_spotify_headers()
+    for queued, uri in enumerate(uris):
+        encoded_uri = urllib.parse.quote(uri)
+        response = await request("POST", f"{SPOTIFY_API_PREFIX}/me/player/queue?uri={encoded_uri}&device_id={await get_bot_device_id()}", priority=BULK, headers=headers)
+        invalidate_playback_snapshot()
+        if not 300 > response.status_code >= 200:
+            if response.status_code == 401: 
+                raise ControllerError(f"add_many_to_queue failed. Looks like you are logged out")
+            raise ControllerError(f"add_many_to_queue failed after queueing {queued} of {len(uris)} with response `{response.status_code}` and text `{response.text}`")
 
-    return None
+        if on_progress is not None:
+            await on_progress(queued + 1, len(uris))
 
+    return len(uris)
 
-def switch_to_device():
-    bot_device_id = get_bot_device_id()
-    headers = get_spotify_headers()
-    response = requests.get(f"{SPOTIFY_API_PREFIX}/me/player/devices", headers=headers)
-    if 300 > response.status_code >= 200:
-        body = json.loads(response.text)
-        for device in body["devices"]:
-            if device["is_active"] and device["id"] == bot_device_id:
-                print("Bot is already the active device")
-                return
 
+async def get_bot_device_id(): 
+    return await device_registry.get_device_id()
+
+
+async def switch_to_device(guild_id: int | None = None):
+    """
+    Transfers playback to the bot's device 
+
+    :param guild_id: Play through this guild's librespot from now on. Keeps the current device if `None`
+    """
+    if guild_id is not None:
+        session = librespot_pool.get(guild_id)
+        if session is not None and session.librespot.device_id and not session.is_active_device():
+            device_registry.set_device(session.librespot.name, session.librespot.device_id, False)
+
+    # Always transfer, even if the registry thinks the bot is active. Playback can be moved to 
+    # another device from the Spotify app without the bot hearing about it
+    bot_device_id = await get_bot_device_id()
+    headers = await get_spotify_headers()
     headers["Content-Type"] = "application/json"
-    response = requests.put(f"{SPOTIFY_API_PREFIX}/me/player", headers=headers, json={
+    response = await request("PUT", f"{SPOTIFY_API_PREFIX}/me/player", headers=headers, json={
         "device_ids": [
             bot_device_id,
         ],
@@ -433,47 +1039,645 @@ def switch_to_device():
     })
     if 300 > response.status_code >= 200 :
         print("Successfully transferred playback")
+        device_registry.is_active = True
     else:
         print(f"switch_to_device failed with code {response.status_code} and text {response.text}")
 
 
-def set_volume_percent(percent: int): 
+async def set_volume_percent(percent: int): 
     if percent < 0 or percent > 100:
         raise ValueError("percent must be between 0 and 100 inclusive")
-    response = requests.put(f"{SPOTIFY_API_PREFIX}/me/player/volume?volume_percent={percent}", headers=get_spotify_headers())
+    response = await request("PUT", f"{SPOTIFY_API_PREFIX}/me/player/volume?volume_percent={percent}", headers=await get_spotify_headers())
     if 300 > response.status_code >= 200:
         print("Successfully set the volume")
     else:
         print(f"set_volume_percent failed with status {response.status_code} and message {response.text}")
 
 
-def start_librespot():
-    global librespot 
-    print(get_access_token())
-    librespot = subprocess.Popen([
-        "librespot",
-        "--name", os.getenv("BOT_NAME"),
-        "--backend", "pipe",
-        "--bitrate", "320",
-        "--access-token", get_access_token()["access_token"],
-        "--enable-volume-normalisation",
-        "--initial-volume", "100",
-    ], stdout=subprocess.PIPE)
-
-
-def stop_librespot():
-    global librespot 
-    if librespot:
-        librespot.terminate()
-        librespot = None
-
-
-def _refresh_librespot():
-    global librespot 
-    print(f"starting refresh thread: Librespot is '{librespot}'")
-    if librespot:
-        print("Waiting to refresh librespot in 1 hour")
-        time.sleep(3590)
-        print("Refreshing librespot")
-        stop_librespot()
-        start_librespot()
+class AudioPipe:
+    """
+    A read-only file-like object over a librespot's audio pipe that can be moved to another 
+    librespot without the reader noticing. Once the old pipe runs dry, reads carry on from the new 
+    one instead of reporting the end of the stream, and the old pipe is closed. Safe to read from 
+    one thread while another calls `swap` or `close`
+    """
+    def __init__(self, source) -> None:
+        self._source = source
+        self._retired: list = []
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def read(self, size: int = -1) -> bytes:
+        while True:
+            source = self._source
+            try:
+                data = source.read(size)
+            except ValueError:
+                # `close` closed the pipe while this read was waiting on it
+                return b""
+            # An empty read is only the end of the stream if nobody swapped in a new pipe meanwhile
+            if data or self._closed or source is self._source:
+                return data
+            self._retire(source)
+
+    def readinto(self, buffer) -> int:
+        while True:
+            source = self._source
+            try:
+                read = source.readinto(buffer)
+            except ValueError:
+                return 0
+            if read or self._closed or source is self._source:
+                return read
+            self._retire(source)
+
+    def swap(self, source):
+        with self._lock:
+            self._retired.append(self._source)
+            self._source = source
+
+    def close(self):
+        """ Closes the current pipe and any swapped out ones that were not read to the end yet """
+        with self._lock:
+            self._closed = True
+            sources = [*self._retired, self._source]
+            self._retired.clear()
+        for source in sources:
+            source.close()
+
+    def _retire(self, source):
+        # The reader is the only one using the old pipe, so once it runs dry nothing needs it
+        with self._lock:
+            if source in self._retired:
+                self._retired.remove(source)
+        source.close()
+
+
+class PCMRingBuffer:
+    """
+    A fixed-size buffer between librespot and the voice client. A thread drains librespot's pipe 
+    into it, so reads never block on librespot
+
+    - When there is no audio to read, such as while playback is paused from the Spotify app, reads 
+      return silence instead of waiting. Otherwise the voice client falls behind while it waits and 
+      rushes through the backlog once audio arrives again. This is an underrun
+    - After an underrun, reads keep returning silence until `prefill` bytes have built up 
+    - `pause` drops everything buffered and keeps dropping audio until `resume`, so nothing stale 
+      is played on resume. Audio dropped while paused is an overrun
+    - When the buffer is full, the drain thread waits for the voice client to catch up
+
+    :param source: The pipe to drain, usually an `AudioPipe`
+    :param capacity: How many bytes to hold
+    :param prefill: How many bytes to build up after an underrun before audio is played again
+    """
+    def __init__(
+        self,
+        source,
+        capacity: int = int(LIBRESPOT_BYTES_PER_SECOND * LIBRESPOT_BUFFER_SECONDS),
+        prefill: int = int(LIBRESPOT_BYTES_PER_SECOND * LIBRESPOT_PREFILL_SECONDS),
+    ) -> None:
+        self.source = source
+        self.capacity = capacity
+        self.prefill = prefill
+        self.underruns = 0
+        self.overruns = 0
+        self.dropped_bytes = 0
+        self._buffer = bytearray(capacity)
+        self._start = 0
+        self._size = 0
+        self._filling = True
+        self._paused = False
+        self._ended = False
+        self._closed = False
+        self._space = threading.Condition()
+        self._thread = threading.Thread(target=self._drain, name="librespot-drain", daemon=True)
+        self._thread.start()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "buffered_bytes": self._size,
+            "underruns": self.underruns,
+            "overruns": self.overruns,
+            "dropped_bytes": self.dropped_bytes,
+        }
+
+    def readinto(self, buffer) -> int:
+        """
+        Copies buffered audio into `buffer`, or fills it with silence if there is not enough 
+
+        :returns: The number of bytes written to `buffer`. 0 only once the pipe has ended and 
+        everything in it has been read
+        """
+        view = memoryview(buffer).cast("B")
+        with self._space:
+            if self._closed:
+                return 0
+            if self._size == 0 and not self._filling:
+                if self._ended:
+                    return 0
+                self.underruns += 1
+                self._filling = True
+            if self._filling:
+                if self._size < self.prefill and not self._ended:
+                    view[:] = bytes(len(view))
+                    return len(view)
+                self._filling = False
+
+            read = min(len(view), self._size)
+            first = min(read, self.capacity - self._start)
+            view[:first] = self._buffer[self._start:self._start + first]
+            view[first:read] = self._buffer[:read - first]
+            self._start = (self._start + read) % self.capacity
+            self._size -= read
+            self._space.notify()
+            return read
+
+    def read(self, size: int = -1) -> bytes:
+        buffer = bytearray(self.capacity if size < 0 else size)
+        return bytes(buffer[:self.readinto(buffer)])
+
+    def pause(self):
+        """ Drops the buffered audio and any that arrives until `resume` """
+        with self._space:
+            self._paused = True
+            self.dropped_bytes += self._size
+            self._start = 0
+            self._size = 0
+            self._space.notify()
+
+    def resume(self):
+        with self._space:
+            self._paused = False
+            self._filling = True
+
+    def close(self):
+        """ Stops draining `source`, which is left open. Reads return the end of the stream from now on """
+        with self._space:
+            self._closed = True
+            self._space.notify()
+
+    def _drain(self):
+        chunk = bytearray(LIBRESPOT_DRAIN_CHUNK)
+        view = memoryview(chunk)
+        while not self._closed:
+            read = self.source.readinto(chunk)
+            if not read:
+                break
+            self._write(view[:read])
+
+        with self._space:
+            self._ended = True
+
+    def _write(self, data: memoryview):
+        with self._space:
+            while data and not self._closed:
+                if self._paused:
+                    self.overruns += 1
+                    self.dropped_bytes += len(data)
+                    return
+                if self._size == self.capacity:
+                    self._space.wait()
+                    continue
+
+                end = (self._start + self._size) % self.capacity
+                written = min(len(data), self.capacity - self._size, self.capacity - end)
+                self._buffer[end:end + written] = data[:written]
+                self._size += written
+                data = data[written:]
+
+
+class Librespot:
+    """
+    A librespot process that plays to a pipe. Audio comes out of `stdout` as 44.1 kHz s16le stereo 
+    PCM. The process's log on stderr is watched to tell when it has logged in to Spotify
+
+    :ivar device_id: The id Spotify gave this librespot's device, once it has shown up
+    :ivar time_to_ready: Seconds from starting the process until its device showed up in Spotify, 
+    or `None` if it has not shown up yet
+    """
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.access_token: str | None = None
+        self.process: asyncio.subprocess.Process | None = None
+        self.stdout = None
+        self.device_id: str | None = None
+        self.is_active = False
+        self.started_at = 0.0
+        self.time_to_ready: float | None = None
+        self._authenticated = asyncio.Event()
+        self._log_task: asyncio.Task | None = None
+
+    def is_running(self) -> bool:
+        return self.process is not None and self.process.returncode is None
+
+    async def start(self, access_token: str):
+        # Audio goes through a plain OS pipe rather than an asyncio stream, because the voice client 
+        # reads it from a thread with ordinary blocking reads
+        read_fd, write_fd = os.pipe()
+        try:
+            self.process = await asyncio.create_subprocess_exec(
+                "librespot",
+                "--name", self.name,
+                "--backend", "pipe",
+                "--bitrate", "320",
+                "--access-token", access_token,
+                "--enable-volume-normalisation",
+                "--initial-volume", "100",
+                stdout=write_fd,
+                stderr=asyncio.subprocess.PIPE,
+            )
+        except:
+            os.close(read_fd)
+            raise
+        finally:
+            os.close(write_fd)
+
+        self.access_token = access_token
+        self.stdout = open(read_fd, "rb", buffering=0)
+        self.started_at = time.monotonic()
+        self._log_task = asyncio.create_task(self._watch_log())
+
+    async def wait_until_ready(self, timeout: float = LIBRESPOT_READY_TIMEOUT) -> bool:
+        """
+        Waits for librespot to log in, then for its device to show up in Spotify 
+
+        :returns: `True` as soon as the device is found. `False` if librespot exits or `timeout` 
+        seconds pass first
+        """
+        deadline = self.started_at + timeout
+        authenticated = asyncio.create_task(self._authenticated.wait())
+        # Stop waiting on the log early in case a librespot update changes what it prints
+        await asyncio.wait({authenticated, self._log_task}, timeout=LIBRESPOT_LOG_GRACE, return_when=asyncio.FIRST_COMPLETED)
+        authenticated.cancel()
+
+        while self.is_running() and time.monotonic() < deadline:
+            device = await find_device(self.name)
+            if device is not None:
+                self.device_id = device["id"]
+                self.is_active = device["is_active"]
+                self.time_to_ready = time.monotonic() - self.started_at
+                print(f"librespot was ready after {self.time_to_ready:.2f} seconds")
+                return True
+            await asyncio.sleep(LIBRESPOT_READY_POLL_INTERVAL)
+
+        return False
+
+    def terminate(self):
+        if self.is_running():
+            self.process.terminate()
+
+    async def _watch_log(self):
+        # stderr has to be drained for as long as the process runs, or librespot blocks once the pipe fills
+        async for line in self.process.stderr:
+            text = line.decode(errors="replace").rstrip()
+            print(f"librespot: {text}")
+            if "Authenticated as" in text:
+                self._authenticated.set()
+        await self.process.wait()
+
+
+def _discard_librespot(librespot: Librespot):
+    """ Stops a librespot that never took over from another, and closes its end of the audio pipe """
+    librespot.terminate()
+    if librespot.stdout is not None:
+        librespot.stdout.close()
+
+
+def _librespot_name(slot: int, previous: Librespot | None = None) -> str:
+    """
+    Every librespot in the pool needs its own name, since librespot derives its device id from 
+    it. The first is called `BOT_NAME` and the rest are numbered. A replacement started while the 
+    old one is still playing also needs a different name, so rotation alternates between the name 
+    with and without a zero width space, which look the same in the Spotify app
+    """
+    name = os.getenv("BOT_NAME")
+    if slot > 0:
+        name = f"{name} {slot + 1}"
+    if previous is not None and previous.name == name:
+        return f"{name}\u200b"
+    return name
+
+
+class LibrespotSession:
+    """
+    One guild's librespot and the audio it plays. The librespot is replaced with a fresh one about 
+    every `LIBRESPOT_ROTATE_INTERVAL` seconds without interrupting `audio`. See `rotate`
+
+    :param guild_id: The guild the session plays to
+    :param slot: Which of the pool's device names the session uses
+    :ivar audio: The session's audio. Give this to the voice client rather than `librespot.stdout`, 
+    so that playback survives rotation
+    """
+    def __init__(self, guild_id: int, slot: int) -> None:
+        self.guild_id = guild_id
+        self.slot = slot
+        self.librespot: Librespot | None = None
+        self.pipe: AudioPipe | None = None
+        self.audio: PCMRingBuffer | None = None
+        self.is_idle = False
+        self._refresh_task: asyncio.Task | None = None
+
+    def is_running(self) -> bool:
+        return self.librespot is not None and self.librespot.is_running()
+
+    def is_active_device(self) -> bool:
+        return (
+            self.librespot is not None
+            and device_registry.device_id is not None
+            and device_registry.device_id == self.librespot.device_id
+        )
+
+    async def start(self, timeout: float = LIBRESPOT_READY_TIMEOUT) -> bool:
+        """
+        Starts librespot and waits until it shows up as a Spotify device 
+
+        :returns: `True` if librespot is ready to play. `False` if it did not become ready within `timeout` seconds
+        """
+        tokens = await get_access_token()
+        self.librespot = Librespot(_librespot_name(self.slot))
+        await self.librespot.start(tokens["access_token"])
+        self.pipe = AudioPipe(self.librespot.stdout)
+        self.audio = PCMRingBuffer(self.pipe)
+        if not await self.librespot.wait_until_ready(timeout):
+            return False
+
+        self._refresh_task = asyncio.create_task(self._refresh())
+        return True
+
+    def assign(self, guild_id: int):
+        """
+        Hands a running session to another guild. The old guild's voice client gets the end of 
+        its stream, and the new guild gets a fresh buffer over the same librespot
+        """
+        self.guild_id = guild_id
+        self.is_idle = False
+        self.audio.close()
+        self.audio = PCMRingBuffer(self.pipe)
+
+    def close(self):
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            self._refresh_task = None
+        if self.audio:
+            self.audio.close()
+        if self.pipe:
+            self.pipe.close()
+        if self.librespot:
+            if self.is_active_device():
+                device_registry.invalidate()
+            self.librespot.terminate()
+
+    async def rotate(self) -> bool:
+        """
+        Replaces the running librespot with one using a fresh access token without interrupting 
+        playback. The replacement is started and allowed to register with Spotify first. If this 
+        session is the active device, playback is transferred to the replacement. Then `pipe` is 
+        pointed at the replacement, and only then is the old process stopped
+
+        :returns: `True` if librespot was replaced. `False` if the replacement never became ready, in 
+        which case the old librespot is left running
+        """
+        old = self.librespot
+        if old is None or self.pipe is None:
+            return False
+
+        warm_start = time.monotonic()
+        token_cache.invalidate()
+        tokens = await get_access_token()
+        # The auth server may not have refreshed its token yet, so ask it to
+        if tokens["access_token"] == old.access_token and tokens.get("refresh_token"):
+            await refresh_token(tokens["refresh_token"])
+            tokens = await get_access_token()
+
+        replacement = Librespot(_librespot_name(self.slot, old))
+        try:
+            await replacement.start(tokens["access_token"])
+            if not await replacement.wait_until_ready():
+                print("LibrespotSession.rotate failed because the replacement librespot never became ready")
+                _discard_librespot(replacement)
+                return False
+
+            swap_start = time.monotonic()
+            is_active_device = self.is_active_device()
+            if is_active_device:
+                was_playing = await is_playing()
+                headers = await get_spotify_headers()
+                headers["Content-Type"] = "application/json"
+                response = await request("PUT", f"{SPOTIFY_API_PREFIX}/me/player", headers=headers, json={
+                    "device_ids": [
+                        replacement.device_id,
+                    ],
+                    "play": bool(was_playing),
+                })
+                if not 300 > response.status_code >= 200:
+                    print(f"LibrespotSession.rotate failed to transfer playback with code {response.status_code} and text {response.text}")
+                    _discard_librespot(replacement)
+                    return False
+        except BaseException:
+            # Covers a replacement that was only partly started, as well as cancellation
+            _discard_librespot(replacement)
+            raise
+
+        self.pipe.swap(replacement.stdout)
+        self.librespot = replacement
+        if is_active_device:
+            device_registry.set_device(replacement.name, replacement.device_id, True)
+            invalidate_playback_snapshot()
+        old.terminate()
+
+        swap_seconds = time.monotonic() - swap_start
+        print(f"Rotated librespot for guild {self.guild_id} in {swap_seconds:.2f} seconds after {swap_start - warm_start:.2f} seconds warming up the replacement")
+        return True
+
+    async def _refresh(self):
+        while self.is_running():
+            print(f"Waiting to refresh librespot in {LIBRESPOT_ROTATE_INTERVAL} seconds")
+            await asyncio.sleep(LIBRESPOT_ROTATE_INTERVAL)
+            print("Refreshing librespot")
+            while self.is_running():
+                try:
+                    if await self.rotate():
+                        break
+                # One failed attempt must not end the task, or librespot's token would expire unrotated
+                except (ControllerError, TypeError, KeyError, OSError) as e:
+                    print(f"LibrespotSession failed to rotate librespot due to `{e}`. Retrying in {LIBRESPOT_ROTATE_RETRY_INTERVAL} seconds")
+                await asyncio.sleep(LIBRESPOT_ROTATE_RETRY_INTERVAL)
+
+
+class LibrespotPool:
+    """
+    Gives each guild its own librespot, so several guilds can each have a device and pipe ready 
+    at once. Sessions are kept in least recently used order. Once `max_sessions` are running, a 
+    guild without a session takes over the least recently used idle session instead of starting a 
+    new librespot. The taken over librespot is already logged in, so it is ready immediately. If 
+    every session is in use, the guild gets none. Concurrent calls to `acquire` for a guild share 
+    one start
+
+    Spotify only plays to one device per account at a time, so guilds can keep sessions warm at 
+    once but only the guild that most recently switched to its device is heard
+
+    :ivar hits: The number of times a guild's own running session was reused
+    :ivar warm_starts: The number of times a guild took over another guild's session
+    :ivar cold_starts: The number of times a new librespot was started
+    :ivar refusals: The number of times a guild got no session because every session was in use
+    """
+    def __init__(self, max_sessions: int = LIBRESPOT_POOL_SIZE) -> None:
+        self.max_sessions = max_sessions
+        self.sessions: OrderedDict[int, LibrespotSession] = OrderedDict()
+        self.hits = 0
+        self.warm_starts = 0
+        self.cold_starts = 0
+        self.refusals = 0
+        self._acquire_tasks: dict[int, asyncio.Task] = {}
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "sessions": len(self.sessions),
+            "idle": sum(session.is_idle for session in self.sessions.values()),
+            "hits": self.hits,
+            "warm_starts": self.warm_starts,
+            "cold_starts": self.cold_starts,
+            "refusals": self.refusals,
+        }
+
+    def is_full(self) -> bool:
+        """ :returns: `True` if there is no room for another session and none are idle to take over """
+        return len(self.sessions) >= self.max_sessions and not any(session.is_idle for session in self.sessions.values())
+
+    def get(self, guild_id: int) -> LibrespotSession | None:
+        """ :returns: The guild's session without starting one, or `None` if it has none """
+        return self.sessions.get(guild_id)
+
+    async def acquire(self, guild_id: int, timeout: float = LIBRESPOT_READY_TIMEOUT) -> LibrespotSession | None:
+        """
+        :returns: The guild's running session, taking over or starting one if needed. `None` if a 
+        new librespot did not become ready within `timeout` seconds, or if every session is in use. 
+        See `is_full`
+        """
+        if guild_id not in self._acquire_tasks:
+            self._acquire_tasks[guild_id] = asyncio.create_task(self._acquire(guild_id, timeout))
+        return await asyncio.shield(self._acquire_tasks[guild_id])
+
+    def release(self, guild_id: int):
+        """ Marks the guild's session idle, so it is the first to be taken over. It keeps running """
+        session = self.sessions.get(guild_id)
+        if session is not None:
+            session.is_idle = True
+
+    def close(self, guild_id: int):
+        session = self.sessions.pop(guild_id, None)
+        if session is not None:
+            session.close()
+
+    def close_all(self):
+        for guild_id in list(self.sessions):
+            self.close(guild_id)
+
+    async def _acquire(self, guild_id: int, timeout: float) -> LibrespotSession | None:
+        try:
+            session = self.sessions.get(guild_id)
+            if session is not None and session.is_running():
+                self.sessions.move_to_end(guild_id)
+                session.is_idle = False
+                self.hits += 1
+                return session
+            self.close(guild_id)
+
+            for other_id, other in list(self.sessions.items()):
+                if not other.is_running():
+                    self.close(other_id)
+
+            if len(self.sessions) >= self.max_sessions:
+                # Take over the least recently used idle session. Sessions in use are never taken, 
+                # since that would cut off a guild that is playing
+                victim_id = next((other_id for other_id, other in self.sessions.items() if other.is_idle), None)
+                if victim_id is None:
+                    self.refusals += 1
+                    print(f"Guild {guild_id} could not get a librespot session because all {self.max_sessions} are in use")
+                    return None
+                session = self.sessions.pop(victim_id)
+                session.assign(guild_id)
+                self.sessions[guild_id] = session
+                self.warm_starts += 1
+                print(f"Guild {guild_id} took over the librespot session of guild {victim_id}")
+                return session
+
+            used_slots = {other.slot for other in self.sessions.values()}
+            slot = next(slot for slot in itertools.count() if slot not in used_slots)
+            session = LibrespotSession(guild_id, slot)
+            self.sessions[guild_id] = session
+            self.cold_starts += 1
+            if not await session.start(timeout):
+                self.close(guild_id)
+                return None
+            return session
+        finally:
+            del self._acquire_tasks[guild_id]
+
+
+librespot_pool = LibrespotPool()
+
+
+async def start_librespot(guild_id: int, timeout: float = LIBRESPOT_READY_TIMEOUT) -> LibrespotSession | None:
+    """
+    Gets a librespot for the guild from `librespot_pool`, starting one and waiting until it shows 
+    up as a Spotify device if needed
+
+    :returns: The guild's session once it is ready to play. `None` if librespot did not become 
+    ready within `timeout` seconds, or if every session in the pool is in use
+    """
+    return await librespot_pool.acquire(guild_id, timeout)
+
+
+def stop_librespot(guild_id: int | None = None):
+    """ Stops the guild's librespot, or every librespot if `guild_id` is `None` """
+    if guild_id is None:
+        librespot_pool.close_all()
+    else:
+        librespot_pool.close(guild_id)
+
+
+def get_librespot_audio(guild_id: int) -> PCMRingBuffer | None:
+    """ :returns: The audio of the guild's librespot, or `None` if it has none """
+    session = librespot_pool.get(guild_id)
+    return session.audio if session is not None else None
+
+
+# ======== Blocking wrappers ========
+# For scripts and the REPL, where there is no event loop to await the controller from. Never 
+# call these from the bot itself
+
+
+def _blocking(coroutine_function):
+    """ 
+    Wraps an async controller function so that it runs to completion on a fresh event loop. 
+    The shared session is closed afterwards since it cannot outlive the loop it was made on
+    """
+    @functools.wraps(coroutine_function)
+    def wrapper(*args, **kwargs):
+        async def run():
+            try:
+                return await coroutine_function(*args, **kwargs)
+            finally:
+                await close_session()
+        return asyncio.run(run())
+    return wrapper
+
+
+is_valid_token_sync = _blocking(is_valid_token)
+logout_sync = _blocking(logout)
+refresh_token_sync = _blocking(refresh_token)
+get_access_token_sync = _blocking(get_access_token)
+is_playing_sync = _blocking(is_playing)
+get_now_playing_sync = _blocking(get_now_playing)
+get_queue_sync = _blocking(get_queue)
+clear_queue_sync = _blocking(clear_queue)
+play_sync = _blocking(play)
+pause_sync = _blocking(pause)
+skip_sync = _blocking(skip)
+search_sync = _blocking(search)
+get_episode_sync = _blocking(get_episode)
+add_to_queue_sync = _blocking(add_to_queue)
+get_bot_device_id_sync = _blocking(get_bot_device_id)
+switch_to_device_sync = _blocking(switch_to_device)
+set_volume_percent_sync = _blocking(set_volume_percent)
@@ -0,0 +1,104 @@
+import asyncio
+from collections import deque
+import os
+import time
+
+import discord
+import numpy as np
+
+
+# How long, in seconds, the bot stays in a voice channel with nothing playing before it leaves
+VOICE_IDLE_TIMEOUT = float(os.getenv("VOICE_IDLE_TIMEOUT", 300))
+
+# How many of the most recent connects and plays `VoiceConnections` keeps timings for
+VOICE_LATENCY_WINDOW = 100
+
+
+class VoiceConnections:
+    """
+    Keeps one voice connection per guild warm for the music and soundboard cogs. Both connect
+    through `connect`, which reuses the guild's voice client when there is one, so a soundboard
+    clip does not pay for a voice handshake while the bot is already in a channel. When a cog is
+    done with a connection it calls `release`, and the bot leaves once nothing has played for
+    `VOICE_IDLE_TIMEOUT` seconds.
+
+    Times how long connecting takes apart from how long a clip takes to start once connected, so
+    slow handshakes and slow clip loading show up separately.
+    """
+
+    def __init__(self, idle_timeout: float = VOICE_IDLE_TIMEOUT) -> None:
+        self.idle_timeout = idle_timeout
+        self.connects = 0
+        self.reuses = 0
+        self._idle_timers: dict[int, asyncio.TimerHandle] = {}
+        self._connect_times: deque[float] = deque(maxlen=VOICE_LATENCY_WINDOW)
+        self._play_times: deque[float] = deque(maxlen=VOICE_LATENCY_WINDOW)
+
+    async def connect(self, channel: discord.VoiceChannel, move: bool = True) -> discord.VoiceClient:
+        """
+        :param channel: The voice channel to be in.
+        :param move: Whether to move an existing connection that is in another channel. A
+            connection that is playing or paused is never moved unless this is True.
+        :returns: The guild's voice client, connected to `channel` unless it was kept where it was.
+        """
+        self.cancel_idle(channel.guild.id)
+        voice_client = channel.guild.voice_client
+        # A voice client that is reconnecting is still the guild's connection, and discord.py
+        # refuses to open a second one
+        if voice_client is not None:
+            self.reuses += 1
+            if voice_client.channel != channel and (move or not (voice_client.is_playing() or voice_client.is_paused())):
+                await voice_client.move_to(channel)
+            return voice_client
+
+        start = time.perf_counter()
+        voice_client = await channel.connect()
+        self._connect_times.append(time.perf_counter() - start)
+        self.connects += 1
+        return voice_client
+
+    def release(self, guild: discord.Guild):
+        """
+        Leaves the guild's voice channel after `idle_timeout` seconds, unless something is playing
+        by then or the connection is used again.
+        """
+        self.cancel_idle(guild.id)
+        loop = asyncio.get_running_loop()
+        self._idle_timers[guild.id] = loop.call_later(
+            self.idle_timeout, lambda: loop.create_task(self._disconnect_idle(guild))
+        )
+
+    def cancel_idle(self, guild_id: int):
+        timer = self._idle_timers.pop(guild_id, None)
+        if timer is not None:
+            timer.cancel()
+
+    def cancel_all(self):
+        for guild_id in list(self._idle_timers):
+            self.cancel_idle(guild_id)
+
+    def record_play(self, seconds: float):
+        """ :param seconds: How long a clip took to start playing once the bot was connected """
+        self._play_times.append(seconds)
+
+    def stats(self) -> dict[str, float]:
+        """ :returns: Connect and play counts, with mean and slowest times in milliseconds """
+        stats = {"connects": self.connects, "reuses": self.reuses, "idle_timers": len(self._idle_timers)}
+        for name, times in (("connect", self._connect_times), ("play", self._play_times)):
+            times = np.array(times) * 1000
+            stats[f"{name}_mean_ms"] = float(times.mean()) if times.size else 0.0
+            stats[f"{name}_max_ms"] = float(times.max()) if times.size else 0.0
+        return stats
+
+    async def _disconnect_idle(self, guild: discord.Guild):
+        self._idle_timers.pop(guild.id, None)
+        voice_client = guild.voice_client
+        if voice_client is None:
+            return
+        if voice_client.is_playing() or voice_client.is_paused():
+            self.release(guild)
+            return
+        await voice_client.disconnect()
+
+
+voice_connections = VoiceConnections()